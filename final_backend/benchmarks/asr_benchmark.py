@@ -0,0 +1,121 @@
+"""Compares ASR backends on real-time factor (RTF) and word error rate (WER).
+
+    python benchmarks/asr_benchmark.py
+    python benchmarks/asr_benchmark.py --configs whisper:base faster-whisper:base:cpu:int8 \
+        --references refs.json clips/*.wav
+
+A config is backend:model[:device[:compute_type]]. RTF is transcription time
+divided by audio duration (lower is faster; < 1 is faster than real time).
+`--references` is a JSON object mapping clip file names to their reference
+transcripts; without it, WER is measured against the first config's output.
+Every config decodes with the same settings (`--beam-size`, greedy by
+default), so differences come from the backend and model alone.
+By default the bundled voice samples in voice-backend/default_voices are used.
+"""
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from services.asr import DEFAULT_BEAM_SIZE, SAMPLE_RATE, SAMPLING_BEST_OF, decode_audio, load_asr
+
+DEFAULT_CLIPS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "voice-backend", "default_voices", "*")
+DEFAULT_CONFIGS = [
+    "whisper:tiny",
+    "faster-whisper:tiny:cpu:int8",
+    "whisper:base",
+    "faster-whisper:base:cpu:int8",
+]
+
+
+def normalize(text: str) -> list:
+    return re.sub(r"[^\w\s']", " ", text.lower()).split()
+
+
+def word_error_rate(reference: str, hypothesis: str) -> float:
+    """Word-level Levenshtein distance divided by the reference length."""
+    ref, hyp = normalize(reference), normalize(hypothesis)
+    if not ref:
+        return 0.0 if not hyp else 1.0
+    previous = list(range(len(hyp) + 1))
+    for i, ref_word in enumerate(ref, 1):
+        current = [i]
+        for j, hyp_word in enumerate(hyp, 1):
+            current.append(min(
+                previous[j] + 1,
+                current[j - 1] + 1,
+                previous[j - 1] + (ref_word != hyp_word)
+            ))
+        previous = current
+    return previous[-1] / len(ref)
+
+
+def parse_config(config: str) -> dict:
+    parts = config.split(":")
+    return {
+        "backend": parts[0],
+        "model_size": parts[1] if len(parts) > 1 else "tiny",
+        "device": parts[2] if len(parts) > 2 else None,
+        "compute_type": parts[3] if len(parts) > 3 else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("clips", nargs="*", help="audio files (default: voice-backend/default_voices)")
+    parser.add_argument("--configs", nargs="+", default=DEFAULT_CONFIGS)
+    parser.add_argument("--references", help="JSON file mapping clip file names to reference text")
+    parser.add_argument("--beam-size", type=int, default=DEFAULT_BEAM_SIZE,
+                        help="beam width used by every config (1 = greedy)")
+    args = parser.parse_args()
+
+    paths = sorted(args.clips or glob.glob(DEFAULT_CLIPS))
+    clips = {}
+    for path in paths:
+        with open(path, "rb") as f:
+            clips[os.path.basename(path)] = decode_audio(f.read(), os.path.splitext(path)[1].lower())
+    total_seconds = sum(len(audio) for audio in clips.values()) / SAMPLE_RATE
+    print(f"{len(clips)} clips, {total_seconds:.1f}s of audio")
+    print(f"Decoding for every config: beam_size={args.beam_size}"
+          f"{' (greedy)' if args.beam_size <= 1 else ''}, temperature fallback with best_of={SAMPLING_BEST_OF}")
+
+    references = None
+    if args.references:
+        with open(args.references, encoding="utf-8") as f:
+            references = json.load(f)
+
+    rows = []
+    for config in args.configs:
+        load_started = time.perf_counter()
+        model = load_asr(**parse_config(config), beam_size=args.beam_size)
+        load_seconds = time.perf_counter() - load_started
+        # Warm-up, so one-off initialisation is not counted against the first clip
+        model.transcribe(next(iter(clips.values())))
+
+        transcripts, elapsed = {}, 0.0
+        for name, audio in clips.items():
+            started = time.perf_counter()
+            transcripts[name] = model.transcribe(audio)["text"]
+            elapsed += time.perf_counter() - started
+
+        if references is None:
+            # No references given: compare everything with the first config
+            references = transcripts
+        scored = [name for name in clips if name in references]
+        wer = sum(word_error_rate(references[name], transcripts[name]) for name in scored) / max(len(scored), 1)
+        rows.append((config, load_seconds, elapsed / total_seconds, wer))
+        del model
+
+    print(f"\n{'config':<36}{'load s':>8}{'RTF':>8}{'WER':>8}")
+    for config, load_seconds, rtf, wer in rows:
+        print(f"{config:<36}{load_seconds:>8.1f}{rtf:>8.3f}{wer:>8.1%}")
+    if not args.references:
+        print(f"\nWER is relative to {args.configs[0]} (pass --references for absolute WER)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+"""OpenAI-compatible stand-in that answers /v1/chat/completions from recorded
+responses (see services/llm_client.py), for offline benchmarks and load tests.
+
+    LLM_MODE=record uvicorn main:app ...             # record once against the real API
+    uvicorn llm_replay_server:app --port 8100        # then serve the recordings
+    LLM_BASE_URL=http://localhost:8100/v1 uvicorn main:app ...
+
+Set LLM_REPLAY_LATENCY to a number of seconds to override the recorded latency.
+"""
+import asyncio
+import time
+from fastapi import FastAPI, HTTPException, Request
+from services.llm_client import CassetteStore
+
+app = FastAPI()
+cassettes = CassetteStore()
+stats = {"hits": 0, "misses": 0}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    # The SDK sends exactly the arguments given to create(), which is what the recordings are keyed by
+    entry = cassettes.load(body)
+    if entry is None:
+        stats["misses"] += 1
+        raise HTTPException(status_code=404, detail=f"No recording for request {cassettes.key(body)[:12]}")
+    stats["hits"] += 1
+
+    await asyncio.sleep(cassettes.delay(entry))
+    usage = entry["usage"]
+    return {
+        "id": f"replay-{cassettes.key(body)[:24]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model"),
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": entry["content"]},
+            "finish_reason": entry.get("finish_reason", "stop"),
+        }],
+        "usage": {
+            "prompt_tokens": usage["prompt_tokens"],
+            "completion_tokens": usage["completion_tokens"],
+            "total_tokens": usage["prompt_tokens"] + usage["completion_tokens"],
+        },
+    }
+
+
+@app.get("/stats")
+async def replay_stats():
+    return stats
@@ -1,12 +1,15 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File
+from fastapi import FastAPI, HTTPException, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from services.generate_story import generate_story
-from services.line_tagging import analyze_and_tag_story
+from fastapi.concurrency import run_in_threadpool
+from services.generate_story import generate_story_chunks, STORY_GENERATION_MODE, story_cache
+from services.line_tagging import analyze_and_tag_story_stream, tagging_metrics, tag_cache
+from services.llm_client import llm
 from pydantic import BaseModel
 import os
 import json
 from dotenv import load_dotenv
 from services.speech_text import speech_processor  # Import the speech processor
+from services.dictation import DictationSession
 
 load_dotenv()
 
@@ -28,10 +31,24 @@ class StoryRequest(BaseModel):
     genre: str
     length: str
     context: str = ""
+    mode: str = STORY_GENERATION_MODE  # "sequential" or "outline"
 
 class VoiceRequest(BaseModel):
     tagged_story: str
 
+def write_and_tag_story(request: StoryRequest) -> tuple:
+    """Generates the story and tags it; blocking, so run off the event loop"""
+    story_chunks = generate_story_chunks(
+        genre=request.genre,
+        length=request.length,
+        context=request.context,
+        api_key=OPENAI_API_KEY,  # Changed to use Gemini key
+        mode=request.mode
+    )
+
+    # Tagging runs alongside generation, chunk by chunk
+    return analyze_and_tag_story_stream(story_chunks, api_key=OPENAI_API_KEY)
+
 @app.post("/generate-story")
 async def create_story(request: StoryRequest):
     try:
@@ -39,17 +56,12 @@ async def create_story(request: StoryRequest):
         print("Gone to story generation")
         os.environ["HTTP_PROXY"] = ""
         os.environ["HTTPS_PROXY"] = ""
-        story = generate_story(
-            genre=request.genre,
-            length=request.length,
-            context=request.context,
-            api_key=OPENAI_API_KEY  # Changed to use Gemini key
-        )
+        # The model round-trips take minutes; keep the loop free for dictation
+        story, tagged_story = await run_in_threadpool(write_and_tag_story, request)
         if not story:
             raise ValueError("Story generation failed")
 
         print(story)
-        tagged_story = analyze_and_tag_story(story, api_key=OPENAI_API_KEY)  # Changed to use Gemini key
         if tagged_story is None:
             raise ValueError("Story tagging failed")
 
@@ -111,22 +123,39 @@ async def generate_voice(request: VoiceRequest):
         print(f"Error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.get("/tagging-metrics")
+async def get_tagging_metrics():
+    """How many lines were tagged locally vs escalated to the model"""
+    return tagging_metrics
+
+@app.get("/llm-metrics")
+async def get_llm_metrics():
+    """Latency, token usage, retries and circuit state of the shared LLM client"""
+    return llm.metrics()
+
+@app.get("/cache-metrics")
+async def get_cache_metrics():
+    """Hit rates of the story-analysis and line-tag caches (None when disabled)"""
+    return {
+        "story_analysis": story_cache.stats() if story_cache else None,
+        "line_tags": tag_cache.stats() if tag_cache else None,
+    }
+
+def require_speech_processor():
+    if speech_processor is None:
+        raise HTTPException(status_code=503, detail="Transcription is disabled (STT_WORKERS=0)")
+    return speech_processor
+
 # Add new endpoint for speech-to-text
 @app.post("/transcribe-audio")
-async def transcribe_audio(audio_file: UploadFile = File(...)):
-    """Endpoint for converting speech to text"""
+async def transcribe_audio(request: Request):
+    """Endpoint for converting speech to text. Takes a multipart form with an
+    audio_file field, read from the body as it streams in"""
     try:
-        # Validate file size (e.g., 10MB limit)
-        max_size = 10 * 1024 * 1024  # 10MB
-        contents = await audio_file.read()
-        if len(contents) > max_size:
-            raise HTTPException(status_code=413, detail="File too large (max 10MB)")
-        
-        # Reset file pointer after reading
-        await audio_file.seek(0)
-        
-        # Process the audio file
-        transcribed_text = await speech_processor.transcribe_audio(audio_file)
+        # Format (400) and size (413, 10MB limit) are enforced as the upload arrives
+        transcribed_text = await require_speech_processor().transcribe_upload(
+            request.headers.get("content-type", ""), request.stream()
+        )
         
         return {
             "status": "success",
@@ -136,4 +165,40 @@ async def transcribe_audio(audio_file: UploadFile = File(...)):
     except HTTPException:
         raise  # Re-raise HTTP exceptions
     except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Transcription failed: {str(e)}")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=f"Transcription failed: {str(e)}")
+
+@app.websocket("/ws/transcribe")
+async def transcribe_stream(websocket: WebSocket):
+    """Live dictation: send 16 kHz mono PCM16 frames as binary messages and
+    {"event": "end"} when done; receive partial and final transcripts as JSON"""
+    await websocket.accept()
+    if speech_processor is None:
+        await websocket.close(code=1013, reason="Transcription is disabled")
+        return
+    session = DictationSession(speech_processor, websocket.send_json)
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                return
+            if message.get("bytes"):
+                await session.feed(message["bytes"])
+            elif message.get("text"):
+                try:
+                    control = json.loads(message["text"])
+                except ValueError:
+                    control = None
+                if not isinstance(control, dict):
+                    await websocket.send_json({"type": "error", "detail": "Control messages must be JSON objects"})
+                    continue
+                if control.get("event") == "end":
+                    await session.finish()
+                    await websocket.close()
+                    return
+    except WebSocketDisconnect:
+        pass
+
+@app.get("/transcription-metrics")
+async def get_transcription_metrics():
+    """Load, rejections and latency of the Whisper worker pool"""
+    return require_speech_processor().metrics()
\ No newline at end of file
@@ -0,0 +1,219 @@
+import os
+import asyncio
+import subprocess
+import tempfile
+import numpy as np
+
+# Speech recognition backends behind one interface, so each service can pick
+# openai-whisper or faster-whisper (CTranslate2, int8 on CPU) through env:
+#   <PREFIX>_ASR_BACKEND       "whisper" or "faster-whisper"
+#   <PREFIX>_ASR_MODEL         model size, e.g. "tiny", "base"
+#   <PREFIX>_ASR_DEVICE        "cpu" or "cuda" (default: cuda if available)
+#   <PREFIX>_ASR_COMPUTE_TYPE  faster-whisper only, e.g. "int8", "float16"
+#   <PREFIX>_ASR_BEAM_SIZE     beam width, the same for both backends; 1 is greedy
+# Both backends decode with the same settings, so they can be compared and
+# swapped without changing accuracy for reasons other than the engine.
+
+SAMPLE_RATE = 16000
+ASR_BACKENDS = ("whisper", "faster-whisper")
+# Greedy decoding, openai-whisper's default
+DEFAULT_BEAM_SIZE = 1
+# Candidates sampled when a segment falls back to a non-zero temperature
+# (faster-whisper's default; openai-whisper would otherwise sample one)
+SAMPLING_BEST_OF = 5
+
+
+def _ffmpeg_command(source: str) -> list:
+    return [
+        "ffmpeg", "-nostdin", "-threads", "0", "-i", source,
+        "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(SAMPLE_RATE), "pipe:1"
+    ]
+
+
+def _pcm_to_array(returncode: int, stdout: bytes, stderr: bytes) -> np.ndarray:
+    if returncode != 0 or not stdout:
+        raise RuntimeError(f"Failed to decode audio: {stderr.decode(errors='ignore')[-300:]}")
+    audio = np.frombuffer(stdout, np.int16).astype(np.float32)
+    audio *= 1 / 32768.0
+    return audio
+
+
+def _ffmpeg_to_array(source: str, data=None) -> np.ndarray:
+    result = subprocess.run(_ffmpeg_command(source), input=data, capture_output=True)
+    return _pcm_to_array(result.returncode, result.stdout, result.stderr)
+
+
+def decode_audio(data, suffix: str = "") -> np.ndarray:
+    """Decodes an in-memory audio file to 16 kHz mono float32, which every backend accepts.
+
+    The bytes are piped through ffmpeg, so nothing is written to disk. MP4/M4A
+    files whose index sits at the end cannot be read from a pipe; only those
+    fall back to a temporary file."""
+    try:
+        return _ffmpeg_to_array("pipe:0", data)
+    except RuntimeError:
+        if suffix != ".m4a":
+            raise
+    with tempfile.NamedTemporaryFile(suffix=suffix) as tmp_file:
+        tmp_file.write(data)
+        tmp_file.flush()
+        return _ffmpeg_to_array(tmp_file.name)
+
+
+class AudioStreamDecoder:
+    """Decodes an audio file to 16 kHz mono float32 while it is still arriving.
+
+    Each chunk passed to `write` goes straight into ffmpeg's stdin, so the
+    encoded file is never held whole in memory or on disk. MP4/M4A keep their
+    index at the end, where a pipe cannot seek; those chunks are written to a
+    temporary file instead and ffmpeg opens it in `finish`. Always `close`
+    the decoder, which also stops ffmpeg if the upload was abandoned."""
+
+    def __init__(self, suffix: str = ""):
+        self.suffix = suffix
+        self._tmp_file = None
+        self._process = None
+        self._output = None
+        self._broken_pipe = False
+
+    async def start(self):
+        if self.suffix == ".m4a":
+            self._tmp_file = tempfile.NamedTemporaryFile(suffix=self.suffix)
+        else:
+            await self._spawn("pipe:0")
+
+    async def _spawn(self, source: str):
+        self._process = await asyncio.create_subprocess_exec(
+            *_ffmpeg_command(source),
+            stdin=subprocess.PIPE if source == "pipe:0" else subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE
+        )
+        # Read while writing, or ffmpeg stalls once its stdout pipe fills
+        self._output = asyncio.gather(self._process.stdout.read(), self._process.stderr.read())
+
+    async def write(self, data: bytes):
+        if self._tmp_file is not None:
+            self._tmp_file.write(data)
+            return
+        if self._broken_pipe:
+            return
+        try:
+            self._process.stdin.write(data)
+            await self._process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            # ffmpeg gave up on the input; finish() reports its error
+            self._broken_pipe = True
+
+    async def finish(self) -> np.ndarray:
+        if self._tmp_file is not None:
+            self._tmp_file.flush()
+            await self._spawn(self._tmp_file.name)
+        elif not self._broken_pipe:
+            self._process.stdin.close()
+        stdout, stderr = await self._output
+        return _pcm_to_array(await self._process.wait(), stdout, stderr)
+
+    async def close(self):
+        if self._process is not None and self._process.returncode is None:
+            self._process.kill()
+            await self._process.wait()
+        if self._output is not None and not self._output.done():
+            self._output.cancel()
+        if self._tmp_file is not None:
+            self._tmp_file.close()
+
+
+def default_device() -> str:
+    try:
+        import torch
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    except ImportError:
+        return "cpu"
+
+
+class WhisperASR:
+    """openai-whisper (PyTorch)."""
+    name = "whisper"
+
+    def __init__(self, model_size: str = "tiny", device: str = None, beam_size: int = DEFAULT_BEAM_SIZE):
+        import whisper
+        self.model = whisper.load_model(model_size, device=device)
+        self.beam_size = beam_size
+
+    def transcribe(self, audio, word_timestamps: bool = False) -> dict:
+        """`audio` is a file path or a 16 kHz float32 array. Returns whisper's
+        result dict: "text", "language" and "segments" (with "words" when
+        word_timestamps is set)."""
+        return self.model.transcribe(
+            audio,
+            word_timestamps=word_timestamps,
+            # None is whisper's greedy decoder
+            beam_size=self.beam_size if self.beam_size > 1 else None,
+            best_of=SAMPLING_BEST_OF
+        )
+
+
+class FasterWhisperASR:
+    """faster-whisper (CTranslate2), whose int8 models run well on CPU-only nodes."""
+    name = "faster-whisper"
+
+    def __init__(
+        self,
+        model_size: str = "tiny",
+        device: str = None,
+        compute_type: str = None,
+        cpu_threads: int = 0,
+        beam_size: int = DEFAULT_BEAM_SIZE
+    ):
+        from faster_whisper import WhisperModel
+        device = device or default_device()
+        compute_type = compute_type or ("float16" if device == "cuda" else "int8")
+        self.model = WhisperModel(model_size, device=device, compute_type=compute_type, cpu_threads=cpu_threads)
+        self.beam_size = beam_size
+
+    def transcribe(self, audio, word_timestamps: bool = False) -> dict:
+        """Same input and result shape as WhisperASR.transcribe."""
+        segments, info = self.model.transcribe(
+            audio, beam_size=self.beam_size, best_of=SAMPLING_BEST_OF, word_timestamps=word_timestamps
+        )
+        result_segments = []
+        for index, segment in enumerate(segments):
+            entry = {"id": index, "start": segment.start, "end": segment.end, "text": segment.text}
+            if word_timestamps:
+                entry["words"] = [
+                    {"word": word.word, "start": word.start, "end": word.end, "probability": word.probability}
+                    for word in segment.words or []
+                ]
+            result_segments.append(entry)
+        return {
+            "text": "".join(segment["text"] for segment in result_segments),
+            "language": info.language,
+            "segments": result_segments
+        }
+
+
+def load_asr(
+    backend: str = "whisper",
+    model_size: str = "tiny",
+    device: str = None,
+    compute_type: str = None,
+    beam_size: int = DEFAULT_BEAM_SIZE
+):
+    """Creates a backend by name."""
+    if backend == "whisper":
+        return WhisperASR(model_size, device=device, beam_size=beam_size)
+    if backend == "faster-whisper":
+        return FasterWhisperASR(model_size, device=device, compute_type=compute_type, beam_size=beam_size)
+    raise ValueError(f"Unknown ASR backend: {backend} (expected one of {', '.join(ASR_BACKENDS)})")
+
+
+def asr_from_env(prefix: str, default_model: str = "tiny", default_backend: str = "whisper"):
+    """Creates the backend configured for one service, e.g. prefix "STT"."""
+    return load_asr(
+        backend=os.getenv(f"{prefix}_ASR_BACKEND", default_backend),
+        model_size=os.getenv(f"{prefix}_ASR_MODEL", default_model),
+        device=os.getenv(f"{prefix}_ASR_DEVICE") or None,
+        compute_type=os.getenv(f"{prefix}_ASR_COMPUTE_TYPE") or None,
+        beam_size=int(os.getenv(f"{prefix}_ASR_BEAM_SIZE", str(DEFAULT_BEAM_SIZE)))
+    )
@@ -0,0 +1,116 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class PersistentCache:
+    """Small SQLite-backed key/value store with TTL and size-based eviction.
+
+    Values are stored as JSON. Entries older than `ttl_seconds` are treated as
+    misses, and once more than `max_entries` are stored the least recently
+    used ones are dropped. Hit/miss counts are kept for reporting.
+
+    Lookups never write: hits are remembered in memory and their access times
+    written in one batch. Expired and surplus rows are removed every
+    `evict_every` inserts rather than on each one, so the table may briefly
+    hold up to that many rows over `max_entries`."""
+
+    def __init__(
+        self,
+        path: str,
+        ttl_seconds: int = 30 * 24 * 3600,
+        max_entries: int = 100000,
+        evict_every: int = 100
+    ):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.evict_every = max(evict_every, 1)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._inserts = 0
+        self._touched = {}
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        # WAL makes each commit an append instead of a rewrite of the journal
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_created_at ON cache (created_at)")
+        self._conn.commit()
+        self._count = self._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def get(self, key: str):
+        """Returns the cached value, or None on a miss."""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, created_at FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or now - row[1] > self.ttl_seconds:
+                self.misses += 1
+                return None
+            self._touched[key] = now
+            if len(self._touched) >= self.evict_every:
+                self._write_touched()
+                self._conn.commit()
+            self.hits += 1
+            return json.loads(row[0])
+
+    def set(self, key: str, value):
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO cache (key, value, created_at, accessed_at) VALUES (?, ?, ?, ?)",
+                (key, json.dumps(value), now, now)
+            )
+            if cursor.rowcount:
+                self._count += 1
+            else:
+                self._conn.execute(
+                    "UPDATE cache SET value = ?, created_at = ?, accessed_at = ? WHERE key = ?",
+                    (json.dumps(value), now, now, key)
+                )
+            self._touched.pop(key, None)
+            self._inserts += 1
+            if self._inserts % self.evict_every == 0 or self._count > self.max_entries + self.evict_every:
+                self._evict(now)
+            self._conn.commit()
+
+    def _write_touched(self):
+        if self._touched:
+            self._conn.executemany(
+                "UPDATE cache SET accessed_at = ? WHERE key = ?",
+                [(accessed_at, key) for key, accessed_at in self._touched.items()]
+            )
+            self._touched.clear()
+
+    def _evict(self, now: float):
+        """Drops expired rows, then the least recently used beyond max_entries."""
+        self._write_touched()
+        self._count -= self._conn.execute(
+            "DELETE FROM cache WHERE created_at < ?", (now - self.ttl_seconds,)
+        ).rowcount
+        if self._count > self.max_entries:
+            self._count -= self._conn.execute(
+                "DELETE FROM cache WHERE key IN "
+                "(SELECT key FROM cache ORDER BY accessed_at ASC LIMIT ?)",
+                (self._count - self.max_entries,)
+            ).rowcount
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0
+        }
@@ -0,0 +1,160 @@
+import os
+import asyncio
+import numpy as np
+from fastapi import HTTPException
+
+# Live dictation over a websocket: the client streams 16 kHz mono PCM16
+# frames, an energy VAD cuts them into utterances, and partial and final
+# transcripts are pushed back as JSON:
+#   {"type": "partial", "utterance": n, "text": "..."}   while the user speaks
+#   {"type": "final", "utterance": n, "text": "..."}     once they pause
+
+SAMPLE_RATE = 16000
+FRAME_SAMPLES = 480  # 30 ms
+# RMS level (full scale = 1.0) above which a frame counts as speech; the
+# effective threshold also rises with the measured background noise
+DICTATION_VAD_THRESHOLD = float(os.getenv("DICTATION_VAD_THRESHOLD", "0.01"))
+# Silence that ends an utterance; most of the end-of-speech latency
+DICTATION_END_SILENCE_MS = int(os.getenv("DICTATION_END_SILENCE_MS", "500"))
+# New speech needed before another partial transcript is attempted
+DICTATION_PARTIAL_INTERVAL_MS = int(os.getenv("DICTATION_PARTIAL_INTERVAL_MS", "700"))
+# Whisper works on 30 s windows; longer utterances are cut here
+DICTATION_MAX_UTTERANCE_S = float(os.getenv("DICTATION_MAX_UTTERANCE_S", "25"))
+PRE_ROLL_FRAMES = 10  # 300 ms kept from before speech starts, so first syllables aren't clipped
+
+
+class UtteranceSegmenter:
+    """Energy-based voice activity detection over a PCM16 stream.
+
+    `feed` accepts raw bytes of any length and returns the utterances that
+    ended inside them, as float32 arrays."""
+
+    def __init__(
+        self,
+        threshold: float = DICTATION_VAD_THRESHOLD,
+        end_silence_ms: int = DICTATION_END_SILENCE_MS,
+        max_utterance_s: float = DICTATION_MAX_UTTERANCE_S
+    ):
+        self.threshold = threshold
+        self.end_silence_frames = max(end_silence_ms * SAMPLE_RATE // 1000 // FRAME_SAMPLES, 1)
+        self.max_frames = int(max_utterance_s * SAMPLE_RATE / FRAME_SAMPLES)
+        self.noise_floor = threshold / 3
+        self._carry = b""
+        self._pending = np.zeros(0, dtype=np.float32)
+        self._pre_roll = []
+        self._frames = []
+        self._silent_frames = 0
+
+    @property
+    def in_speech(self) -> bool:
+        return bool(self._frames)
+
+    def current(self) -> np.ndarray:
+        """Audio of the utterance in progress."""
+        return np.concatenate(self._frames) if self._frames else np.zeros(0, dtype=np.float32)
+
+    def speech_samples(self) -> int:
+        return len(self._frames) * FRAME_SAMPLES
+
+    def _end_utterance(self) -> np.ndarray:
+        # Drop most of the trailing silence, keep a little for the last word
+        keep = len(self._frames) - max(self._silent_frames - PRE_ROLL_FRAMES, 0)
+        audio = np.concatenate(self._frames[:keep])
+        self._frames = []
+        self._silent_frames = 0
+        return audio
+
+    def feed(self, pcm: bytes) -> list:
+        data = self._carry + pcm
+        usable = len(data) - len(data) % 2
+        self._carry = data[usable:]
+        samples = np.frombuffer(data[:usable], dtype="<i2").astype(np.float32) / 32768.0
+        self._pending = np.concatenate([self._pending, samples])
+
+        finished = []
+        while len(self._pending) >= FRAME_SAMPLES:
+            frame, self._pending = self._pending[:FRAME_SAMPLES], self._pending[FRAME_SAMPLES:]
+            rms = float(np.sqrt(np.mean(frame * frame)))
+            is_speech = rms > max(self.threshold, self.noise_floor * 3)
+
+            if not self._frames:
+                if is_speech:
+                    self._frames = self._pre_roll + [frame]
+                    self._pre_roll = []
+                    self._silent_frames = 0
+                else:
+                    # Track background noise while nobody is speaking
+                    self.noise_floor = 0.95 * self.noise_floor + 0.05 * rms
+                    self._pre_roll = (self._pre_roll + [frame])[-PRE_ROLL_FRAMES:]
+                continue
+
+            self._frames.append(frame)
+            self._silent_frames = 0 if is_speech else self._silent_frames + 1
+            if self._silent_frames >= self.end_silence_frames or len(self._frames) >= self.max_frames:
+                finished.append(self._end_utterance())
+        return finished
+
+    def flush(self) -> list:
+        """Ends the stream; returns the utterance in progress, if any."""
+        return [self._end_utterance()] if self._frames else []
+
+
+class DictationSession:
+    """One websocket's dictation state.
+
+    Final transcripts are produced in order as utterances end. Partials run in
+    the background only when a worker is idle, so they never queue in front of
+    finals or uploads. A partial still running when its utterance ends is left
+    to finish (its worker cannot be interrupted) and its text is dropped."""
+
+    def __init__(self, processor, send):
+        self.processor = processor
+        self.send = send
+        self.segmenter = UtteranceSegmenter()
+        self.utterance = 0
+        self._partial_task = None
+        self._partial_at = 0
+        self._partial_interval = DICTATION_PARTIAL_INTERVAL_MS * SAMPLE_RATE // 1000
+
+    async def _partial(self, utterance: int, audio: np.ndarray):
+        try:
+            text = await self.processor.transcribe_array(audio)
+        except Exception:
+            return  # e.g. pool overloaded; partials are best effort
+        if utterance == self.utterance and text.strip():
+            try:
+                await self.send({"type": "partial", "utterance": utterance, "text": text.strip()})
+            except Exception:
+                pass  # The socket closed while this partial was running
+
+    async def _final(self, audio: np.ndarray):
+        utterance = self.utterance
+        self.utterance += 1
+        self._partial_at = 0
+        try:
+            text = await self.processor.transcribe_array(audio)
+        except HTTPException as e:
+            await self.send({"type": "error", "utterance": utterance, "detail": e.detail})
+            return
+        except Exception as e:
+            await self.send({"type": "error", "utterance": utterance, "detail": f"Transcription error: {str(e)}"})
+            return
+        await self.send({"type": "final", "utterance": utterance, "text": text.strip()})
+
+    async def feed(self, pcm: bytes):
+        for audio in self.segmenter.feed(pcm):
+            await self._final(audio)
+
+        speech = self.segmenter.speech_samples()
+        if (
+            self.segmenter.in_speech
+            and speech - self._partial_at >= self._partial_interval
+            and (self._partial_task is None or self._partial_task.done())
+            and self.processor.has_idle_worker()
+        ):
+            self._partial_at = speech
+            self._partial_task = asyncio.create_task(self._partial(self.utterance, self.segmenter.current()))
+
+    async def finish(self):
+        for audio in self.segmenter.flush():
+            await self._final(audio)
@@ -1,14 +1,75 @@
+import hashlib
 import json
-from openai import OpenAI
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from services.llm_client import llm
+from services.cache import PersistentCache
 load_dotenv()
 
-def generate_story(genre: str, length: str, context: str = "", api_key: str = os.getenv("OPENAI_API_KEY")) -> str:
-    # Initialize client with API key
-    client = OpenAI(api_key=api_key)
-    
+# "sequential" continues the story chunk by chunk; "outline" plans sections
+# first and writes them concurrently
+STORY_GENERATION_MODE = os.getenv("STORY_GENERATION_MODE", "sequential")
+# Words per chunk in sequential mode
+SECTION_WORDS = 1000
+# Words per section in outline mode: stories longer than this are split into
+# ceil(target / OUTLINE_SECTION_WORDS) sections ("medium" 2, "long" 3)
+OUTLINE_SECTION_WORDS = int(os.getenv("OUTLINE_SECTION_WORDS", "350"))
+# How many sections are written at once
+STORY_SECTION_WORKERS = int(os.getenv("STORY_SECTION_WORKERS", "4"))
+# Cheaper model used to smooth the joins between sections
+STITCH_MODEL = os.getenv("STITCH_MODEL", "gpt-3.5-turbo")
+
+# Model for the context analysis and blueprint stages. Their results are
+# reused for the same genre and context; bump STORY_PROMPT_VERSION whenever
+# those two prompts change.
+ANALYSIS_MODEL = "gpt-4"
+STORY_PROMPT_VERSION = "1"
+STORY_CACHE_PATH = os.getenv("STORY_CACHE_PATH", "cache/story_cache.sqlite3")
+STORY_CACHE_TTL = int(os.getenv("STORY_CACHE_TTL", str(7 * 24 * 3600)))
+story_cache = PersistentCache(STORY_CACHE_PATH, STORY_CACHE_TTL, max_entries=10000) if STORY_CACHE_PATH else None
+
+
+def _stage_key(stage: str, genre: str, context: str) -> str:
+    payload = json.dumps([stage, genre, context, ANALYSIS_MODEL, STORY_PROMPT_VERSION], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _cached_stage(stage: str, genre: str, context: str):
+    """Returns the stored result of an analysis stage for this request, or None."""
+    if story_cache is None:
+        return None
+    try:
+        value = story_cache.get(_stage_key(stage, genre, context))
+    except Exception as e:
+        print(f"⚠️ Story cache read failed: {e}")
+        return None
+    print(f"📊 Story cache hit rate: {story_cache.stats()['hit_rate']:.0%}")
+    return value
+
+
+def _store_stage(stage: str, genre: str, context: str, value):
+    if story_cache is None:
+        return
+    try:
+        story_cache.set(_stage_key(stage, genre, context), value)
+    except Exception as e:
+        print(f"⚠️ Story cache write failed: {e}")
+
+def generate_story(genre: str, length: str, context: str = "", api_key: str = os.getenv("OPENAI_API_KEY"), mode: str = STORY_GENERATION_MODE) -> str:
+    full_story = ""
+    for chunk in generate_story_chunks(genre, length, context, api_key, mode):
+        full_story += "\n\n" + chunk
+    return full_story
+
+
+def generate_story_chunks(genre: str, length: str, context: str = "", api_key: str = os.getenv("OPENAI_API_KEY"), mode: str = STORY_GENERATION_MODE):
+    """Yields the story one generated chunk at a time, so callers can start
+    processing the text before the whole story has been written.
+    With mode="outline", stories longer than OUTLINE_SECTION_WORDS are
+    outlined first and their sections written concurrently; they are still
+    yielded in order."""
     print("🔑 Using OPENAI_API_KEY:", api_key[:8] + "..." if api_key else "Not Found")
 
     length_mapping = {
@@ -18,6 +79,35 @@ def generate_story(genre: str, length: str, context: str = "", api_key: str = os
     }
     target_word_count = length_mapping.get(length.lower(), 3500)
 
+    # Retries and re-runs of the same request skip both analysis stages
+    enhanced_prompt = _cached_stage("blueprint", genre, context)
+    if enhanced_prompt is None:
+        data = _cached_stage("structure", genre, context)
+        if data is None:
+            data = _extract_structure(genre, context, api_key)
+            if data is None:
+                return
+            _store_stage("structure", genre, context, data)
+
+        enhanced_prompt = _enhance_prompt(genre, data, api_key)
+        if enhanced_prompt is None:
+            return
+        _store_stage("blueprint", genre, context, enhanced_prompt)
+    else:
+        print("♻️ Reusing cached story blueprint")
+
+    if mode == "outline" and target_word_count > OUTLINE_SECTION_WORDS:
+        sections = _outline_sections(api_key, enhanced_prompt, target_word_count)
+        if sections:
+            yield from _generate_sections(api_key, enhanced_prompt, sections, target_word_count)
+            return
+        print("⚠️ Falling back to sequential generation")
+
+    yield from _generate_sequential(api_key, enhanced_prompt, target_word_count)
+
+
+def _extract_structure(genre: str, context: str, api_key: str) -> dict:
+    """Stage 1: characters, scenes and tone extracted from the user's context as JSON."""
     story_prompt = f"""
 Please analyze the following story context and extract structured information. Return ONLY valid JSON with no additional commentary.
 
@@ -48,8 +138,9 @@ If any field cannot be determined, use an empty list for "characters" or "scenes
 """
 
     try:
-        response = client.chat.completions.create(
-            model="gpt-4",
+        response = llm.chat(
+            api_key=api_key,
+            model=ANALYSIS_MODEL,
             messages=[
                 {
                     "role": "system",
@@ -64,24 +155,30 @@ If any field cannot be determined, use an empty list for "characters" or "scenes
         response_text = response.choices[0].message.content
     except Exception as e:
         print("❌ Error generating JSON structure:", e)
-        return ""
+        return None
 
     print("📦 Raw OpenAI JSON response:\n", response_text)
  
     json_match = re.search(r'\{[\s\S]*\}', response_text)
     if not json_match:
         print("❌ No valid JSON found in OpenAI response.")
-        return ""
+        return None
 
     try:
         data = json.loads(json_match.group())
     except json.JSONDecodeError as e:
         print("❌ JSON decoding failed:", e)
-        return ""
+        return None
 
     if context and not data.get("scenes"):
         data["scenes"] = [{"description": context, "mood": "neutral"}]
 
+    return data
+
+
+def _enhance_prompt(genre: str, data: dict, api_key: str) -> str:
+    """Stage 2: turns the extracted structure into the narrative blueprint
+    that the story chunks are written from."""
     # Build the story prompt with characters and scenes
     story_prompt = f"Tone: {genre}\n"
     if data.get("characters"):
@@ -100,8 +197,9 @@ If any field cannot be determined, use an empty list for "characters" or "scenes
 
     # Enhanced prompt generation
     try:
-        enhanced_response = client.chat.completions.create(
-            model="gpt-4",
+        enhanced_response = llm.chat(
+            api_key=api_key,
+            model=ANALYSIS_MODEL,
             messages=[
                 {
                     "role": "system",
@@ -150,8 +248,13 @@ Craft a prompt so compelling that the AI has no choice but to generate a masterp
         enhanced_prompt = enhanced_response.choices[0].message.content
     except Exception as e:
         print("❌ Error generating enhanced prompt:", e)
-        return ""
+        return None
+
+    return enhanced_prompt
+
 
+def _generate_sequential(api_key: str, enhanced_prompt: str, target_word_count: int):
+    """Writes the story one chunk after another, each continuing the last."""
     full_story = ""
     current_word_count = 0
     chunk_count = 0
@@ -160,7 +263,7 @@ Craft a prompt so compelling that the AI has no choice but to generate a masterp
         while current_word_count < target_word_count:
             chunk_count += 1
             remaining_words = target_word_count - current_word_count
-            chunk_size = min(1000, remaining_words)
+            chunk_size = min(SECTION_WORDS, remaining_words)
 
             if chunk_count > 1:
                 continuation_prompt = f"""
@@ -173,7 +276,8 @@ Craft a prompt so compelling that the AI has no choice but to generate a masterp
             else:
                 continuation_prompt = enhanced_prompt
 
-            response = client.chat.completions.create(
+            response = llm.chat(
+                api_key=api_key,
                 model="gpt-4",
                 messages=[
                     {
@@ -191,9 +295,168 @@ Craft a prompt so compelling that the AI has no choice but to generate a masterp
             current_word_count = len(full_story.split())
 
             print(f"✅ Generated chunk {chunk_count} (~{len(chunk.split())} words), total: ~{current_word_count} words")
-
-        return full_story
+            yield chunk
 
     except Exception as e:
         print(f"❌ Error generating text: {e}")
-        return full_story if full_story else ""
\ No newline at end of file
+
+
+def _outline_sections(api_key: str, enhanced_prompt: str, target_word_count: int) -> list:
+    """Plans the story as sections that can be written independently.
+
+    Each section comes back as {"summary", "opening", "ending"}: what happens
+    in it, and the situation it starts from and leaves behind, so writers of
+    neighbouring sections agree on who is where and what is known.
+    Returns None if no usable outline is produced."""
+    section_count = -(-target_word_count // OUTLINE_SECTION_WORDS)
+    outline_prompt = f"""
+Plan the following story as exactly {section_count} consecutive sections of about {target_word_count // section_count} words each. Return ONLY valid JSON with no additional commentary.
+
+STORY BLUEPRINT:
+{enhanced_prompt}
+
+The JSON output must follow this structure exactly:
+{{
+  "sections": [
+      {{
+         "summary": string,
+         "opening": string,
+         "ending": string
+      }},
+      ...
+  ]
+}}
+
+"summary" says what happens in the section. "opening" and "ending" are continuity notes: which characters are present, where they are, what they know and the mood at the very start and very end of the section. Each section's "opening" must match the previous section's "ending".
+"""
+
+    try:
+        response = llm.chat(
+            api_key=api_key,
+            model="gpt-4",
+            messages=[
+                {
+                    "role": "system",
+                    "content": "You are a story planner that splits stories into sections with precise continuity notes."
+                },
+                {
+                    "role": "user",
+                    "content": outline_prompt
+                }
+            ]
+        )
+        response_text = response.choices[0].message.content
+        json_match = re.search(r'\{[\s\S]*\}', response_text)
+        sections = json.loads(json_match.group())["sections"] if json_match else None
+    except Exception as e:
+        print("❌ Error generating outline:", e)
+        return None
+
+    if not sections or not all(isinstance(section, dict) and section.get("summary") for section in sections):
+        print("❌ No valid outline found in OpenAI response.")
+        return None
+
+    print(f"🗺️ Outlined {len(sections)} sections")
+    return sections
+
+
+def _write_section(api_key: str, enhanced_prompt: str, sections: list, index: int, target_word_count: int) -> str:
+    outline = "\n".join(f"{n}. {section['summary']}" for n, section in enumerate(sections, 1))
+    section = sections[index]
+    section_prompt = f"""
+{enhanced_prompt}
+
+The story is written in {len(sections)} sections by different writers at the same time. This is the outline:
+{outline}
+
+Write ONLY section {index + 1} (about {target_word_count // len(sections)} words): {section['summary']}
+It must start exactly from this situation: {section.get('opening', '')}
+It must end exactly in this situation: {section.get('ending', '')}
+{"Begin the story." if index == 0 else "Do not recap earlier sections; continue straight on."}
+{"End the story." if index == len(sections) - 1 else "Do not conclude the story."}
+"""
+
+    response = llm.chat(
+        api_key=api_key,
+        model="gpt-4",
+        messages=[
+            {
+                "role": "system",
+                "content": f"You are a creative writer that writes one of the best stories in the world. Current target: {target_word_count} words total."
+            },
+            {
+                "role": "user",
+                "content": section_prompt
+            }
+        ]
+    )
+    return response.choices[0].message.content
+
+
+def _stitch_sections(api_key: str, previous: str, section: str) -> str:
+    """Rewrites the first paragraph of `section` so it follows on from the end
+    of `previous`. Returns `section` unchanged if the rewrite fails."""
+    previous_end = previous.strip().split("\n\n")[-1]
+    paragraphs = section.strip().split("\n\n", 1)
+
+    try:
+        response = llm.chat(
+            api_key=api_key,
+            model=STITCH_MODEL,
+            messages=[
+                {
+                    "role": "system",
+                    "content": "You are an editor smoothing the join between two parts of a story. Only respond with the rewritten paragraph."
+                },
+                {
+                    "role": "user",
+                    "content": f"""Rewrite the NEXT PARAGRAPH so it follows naturally from the PREVIOUS PARAGRAPH. Remove any repetition or recap, fix contradictions and keep its events, dialogue and length.
+
+PREVIOUS PARAGRAPH:
+{previous_end}
+
+NEXT PARAGRAPH:
+{paragraphs[0]}"""
+                }
+            ],
+            temperature=0.3
+        )
+        opening = response.choices[0].message.content.strip()
+    except Exception as e:
+        print(f"⚠️ Stitching failed, keeping section as written: {e}")
+        return section
+
+    if not opening:
+        return section
+    return "\n\n".join([opening] + paragraphs[1:])
+
+
+def _generate_sections(api_key: str, enhanced_prompt: str, sections: list, target_word_count: int):
+    """Writes all outlined sections concurrently and yields them in order,
+    each one's opening stitched to the end of the one before."""
+    with ThreadPoolExecutor(max_workers=max(STORY_SECTION_WORKERS, 1)) as writers, \
+            ThreadPoolExecutor(max_workers=max(STORY_SECTION_WORKERS, 1)) as stitchers:
+        written = [
+            writers.submit(_write_section, api_key, enhanced_prompt, sections, index, target_word_count)
+            for index in range(len(sections))
+        ]
+        # Each join only needs its two sections, so joins are stitched as soon as both exist
+        stitched = [written[0]] + [
+            stitchers.submit(
+                lambda index: _stitch_sections(api_key, written[index - 1].result(), written[index].result()),
+                index
+            )
+            for index in range(1, len(sections))
+        ]
+
+        word_count = 0
+        try:
+            for index, future in enumerate(stitched, 1):
+                chunk = future.result()
+                word_count += len(chunk.split())
+                print(f"✅ Generated section {index}/{len(sections)} (~{len(chunk.split())} words), total: ~{word_count} words")
+                yield chunk
+        except Exception as e:
+            print(f"❌ Error generating text: {e}")
+            for future in written + stitched:
+                future.cancel()
@@ -1,182 +1,864 @@
-import openai  
 import time
 import os
+import re
+import json
+import hashlib
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from services.rate_limiter import TokenBucketRateLimiter
+from services.cache import PersistentCache
+from services.llm_client import llm, CircuitOpenError
 
 load_dotenv()
 
+# Maximum number of tagging requests in flight at once
+TAGGING_WORKERS = int(os.getenv("TAGGING_WORKERS", "4"))
+# Provider limits shared by every tagging request (0 disables the limit)
+TAGGING_RPM = int(os.getenv("TAGGING_RPM", "0"))
+TAGGING_TPM = int(os.getenv("TAGGING_TPM", "0"))
+# Lines sent per request in batched mode (0 keeps one request per line)
+TAGGING_BATCH_SIZE = int(os.getenv("TAGGING_BATCH_SIZE", "0"))
+
+# Lines the local tagger is at least this sure about never reach the model
+LOCAL_TAG_THRESHOLD = float(os.getenv("LOCAL_TAG_THRESHOLD", "0.8"))
+# Tags returned by the model are reused for identical lines in the same context.
+# Bump TAGGING_PROMPT_VERSION whenever the tagging prompts change.
+TAGGING_PROMPT_VERSION = "1"
+TAG_CACHE_PATH = os.getenv("TAG_CACHE_PATH", "cache/tag_cache.sqlite3")
+TAG_CACHE_TTL = int(os.getenv("TAG_CACHE_TTL", str(30 * 24 * 3600)))
+TAG_CACHE_MAX_ENTRIES = int(os.getenv("TAG_CACHE_MAX_ENTRIES", "100000"))
+# Stories longer than this many characters are scanned for names in chunks
+CHARACTER_SCAN_CHUNK_CHARS = int(os.getenv("CHARACTER_SCAN_CHUNK_CHARS", "6000"))
+
+EMOTIONS = ["neutral", "joy", "fear", "anger", "sadness", "suspense"]
+# Matched as whole words, so inflections are listed
+EMOTION_KEYWORDS = {
+    "joy": ["happy", "laugh", "laughed", "laughing", "smile", "smiled", "smiling", "joy",
+            "grin", "grinned", "grinning", "delighted"],
+    "fear": ["afraid", "fear", "feared", "terrified", "scared", "trembling", "trembled"],
+    "anger": ["angry", "angrily", "furious", "furiously", "rage", "raged", "yelled", "snapped"],
+    "sadness": ["sad", "sadly", "tears", "cried", "crying", "sorrow", "grief"],
+    "suspense": ["suspense", "tense", "uncertain", "waited", "waiting"],
+}
+ATTRIBUTION_VERBS = ["said", "asked", "replied", "whispered", "shouted", "exclaimed"]
+# Dropped from the front of a name when deciding whether two names are the same person
+NAME_TITLES = {"mr", "mrs", "ms", "miss", "dr", "prof", "professor", "sir", "lady", "lord", "captain", "capt"}
+# Abbreviations that are the same title
+TITLE_SPELLINGS = {"prof": "professor", "capt": "captain"}
+# Longer scanned "names" are parts of a rambling reply and are dropped
+MAX_NAME_LENGTH = 60
+# A single quote that is not an apostrophe inside a word ("John's", "didn't")
+_SINGLE_QUOTE = re.compile(r"\u2018|(?<!\w)['\u2019]|['\u2019](?!\w)")
+
+# Counts of lines tagged locally vs escalated to the model, since startup
+tagging_metrics = {
+    "lines_total": 0,
+    "lines_local": 0,
+    "lines_escalated": 0,
+    "escalation_rate": 0.0
+}
+_metrics_lock = threading.Lock()
+
+rate_limiter = TokenBucketRateLimiter(rpm=TAGGING_RPM, tpm=TAGGING_TPM)
+tag_cache = PersistentCache(TAG_CACHE_PATH, TAG_CACHE_TTL, TAG_CACHE_MAX_ENTRIES) if TAG_CACHE_PATH else None
+
+
+def _cache_key(model_name: str, line: str, context: list, potential_characters: list) -> str:
+    payload = json.dumps(
+        [model_name, TAGGING_PROMPT_VERSION, line, context, sorted(potential_characters)],
+        ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _cached_tag(key: str):
+    """Returns the cached "<Character><emotion>" tag for a key, or None."""
+    if tag_cache is None:
+        return None
+    try:
+        return tag_cache.get(key)
+    except Exception as e:
+        print(f"Warning: Tag cache read failed: {e}")
+        return None
+
+
+def _store_tag(key: str, tag: str):
+    if tag_cache is None:
+        return
+    try:
+        tag_cache.set(key, tag)
+    except Exception as e:
+        print(f"Warning: Tag cache write failed: {e}")
+
+
+def _chat_completion(model_name: str, api_key: str, messages: list, temperature: float, max_tokens: int) -> str:
+    """Sends one chat request with the caller's key and returns the reply text.
+    Every request the client sends for it, retries and hedges included, goes
+    through the rate limiter."""
+    return llm.chat_text(
+        messages,
+        model=model_name,
+        api_key=api_key,
+        rate_limiter=rate_limiter,
+        temperature=temperature,
+        max_tokens=max_tokens
+    )
+
+
+def _scan_characters(story_text: str, model_name: str, api_key: str) -> list:
+    """Asks the model for the character names appearing in a piece of the story."""
+    character_scan_prompt = (
+        "Extract ALL character names from this story excerpt. Only respond with a comma-separated list of names.\n"
+        "Look for:\n"
+        "1. Names in dialogue tags (e.g., \"Hello,\" said John)\n"
+        "2. Names mentioned in conversation\n"
+        "3. Names of anyone performing actions\n\n"
+        f"STORY EXCERPT:\n{story_text}"
+    )
+
+    char_response = _chat_completion(
+        model_name,
+        api_key,
+        [
+            {"role": "system", "content": "You are a character name extractor. Only respond with a comma-separated list of names."},
+            {"role": "user", "content": character_scan_prompt}
+        ],
+        temperature=0.2,
+        max_tokens=150
+    )
+    return [name.strip() for name in char_response.split(',')]
+
+
+def _split_for_scan(lines: list, chunk_chars: int) -> list:
+    """Groups whole lines into pieces of at most ~chunk_chars characters."""
+    chunks, current, size = [], [], 0
+    for line in lines:
+        if current and size + len(line) > chunk_chars:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+def _scan_characters_chunked(
+    lines: list,
+    model_name: str,
+    api_key: str,
+    executor,
+    chunk_chars: int = CHARACTER_SCAN_CHUNK_CHARS
+) -> list:
+    """Scans the story for names in chunks, all in flight at once on `executor`.
+
+    Each chunk is a separate short prompt, so the scan takes about as long as
+    one chunk however long the story is, and no chunk's name list gets cut
+    off by max_tokens. Returns the raw names in story order; a chunk whose
+    scan fails is skipped."""
+    chunks = _split_for_scan(lines, chunk_chars) if chunk_chars > 0 else ["\n".join(lines)]
+    futures = [executor.submit(_scan_characters, chunk, model_name, api_key) for chunk in chunks]
+
+    names = []
+    for index, future in enumerate(futures, 1):
+        try:
+            names.extend(future.result())
+        except Exception as e:
+            print(f"Warning: Character scan of chunk {index}/{len(chunks)} failed: {e}")
+    if len(chunks) > 1:
+        print(f"Scanned {len(chunks)} chunks for characters")
+    return names
+
+
+def _clean_name(name: str) -> str:
+    """Strips list punctuation and a trailing possessive from a scanned name."""
+    name = name.strip().strip("*-.\"'").strip()
+    return re.sub(r"['\u2019]s$", "", name)
+
+
+def _name_key(name: str) -> tuple:
+    """(title, name) compared case-insensitively, so "Dr. Watson" and "dr watson"
+    are equal; the title is "" for a bare name."""
+    words = name.split()
+    titles = []
+    while len(words) > 1 and words[0].rstrip(".").lower() in NAME_TITLES:
+        title = words.pop(0).rstrip(".").lower()
+        titles.append(TITLE_SPELLINGS.get(title, title))
+    return " ".join(titles), " ".join(words).casefold()
+
+
+def _merge_character_names(names: list) -> tuple:
+    """Deduplicates scanned names and works out which ones are aliases.
+
+    Names equal up to case or a possessive "'s" are one character, spelled
+    as first seen (capitalised spellings win). A bare name joins the titled
+    form of it ("Watson" and "Dr. Watson") when there is only one, while
+    different titles ("Mr. Smith", "Mrs. Smith") stay different people; a
+    title on its own is not a name. A single-word name that is part of
+    exactly one longer name ("John" and "John Smith") is folded into the
+    longer one. Returns (characters, aliases) where aliases maps every
+    other spelling to its character, for StoryMatcher."""
+    groups = {}
+    for name in names:
+        name = _clean_name(name)
+        if not re.search(r"\w", name) or name.lower() in ("none", "n/a", "unknown"):
+            continue
+        if len(name) > MAX_NAME_LENGTH or name.rstrip(".").lower() in NAME_TITLES:
+            continue
+        spellings = groups.setdefault(_name_key(name), [])
+        # Prefer a capitalised spelling over a lowercase one seen first
+        if spellings and spellings[0].islower() and not name.islower():
+            spellings.insert(0, name)
+        else:
+            spellings.append(name)
+
+    titled = {}
+    for title, bare in groups:
+        if title:
+            titled.setdefault(bare, []).append((title, bare))
+
+    # Fold bare names into their only titled form, then single words into
+    # the one full name containing them, if unambiguous
+    parent = {}
+    for key in groups:
+        if not key[0] and len(titled.get(key[1], [])) == 1:
+            parent[key] = titled[key[1]][0]
+    for key in groups:
+        if key[0] or " " in key[1] or key in parent or key[1] in titled:
+            continue
+        owners = [
+            other for other in groups
+            if other not in parent and " " in other[1] and key[1] in other[1].split()
+        ]
+        if len(owners) == 1:
+            parent[key] = owners[0]
+
+    characters = [spellings[0] for key, spellings in groups.items() if key not in parent]
+    aliases = {}
+    for key, spellings in groups.items():
+        root = key
+        while root in parent:
+            root = parent[root]
+        canonical = groups[root][0]
+        forms = list(spellings)
+        # The title-less form lets "Watson" in the text match "Dr. Watson"
+        # unless another title claims it too
+        if key[0] and len(titled[key[1]]) == 1:
+            forms.append(" ".join(spellings[0].split()[-len(key[1].split()):]))
+        for spelling in forms:
+            if spelling != canonical and spelling not in characters:
+                aliases[spelling] = canonical
+    return characters, aliases
+
+
+def _trie_pattern(words) -> str:
+    """Builds a regex alternation for `words` factored as a prefix trie.
+
+    Python's re tries alternatives one by one, so a flat "a|b|c|..." costs
+    time per word at every position; the trie only branches on the next
+    character. Longer words are preferred where one is a prefix of another."""
+    trie = {}
+    for word in words:
+        node = trie
+        for c in word:
+            node = node.setdefault(c, {})
+        node[""] = {}
+
+    def build(node) -> str:
+        branches = []
+        for c in sorted(key for key in node if key):
+            branches.append(re.escape(c) + build(node[c]))
+        if not branches:
+            return ""
+        if "" in node:
+            branches.append("")
+        if len(branches) == 1:
+            return branches[0]
+        return "(?:" + "|".join(branches) + ")"
+
+    return build(trie)
+
+
+class StoryMatcher:
+    """Character names, attribution verbs and emotion keywords compiled into a
+    single trie-shaped regex, so one scan of a line yields everything
+    _local_tag needs, however large the cast.
+
+    The scan runs over the lowercased line; keywords match case-insensitively
+    and names are then checked against their original spelling. Tokens only
+    match whole words, so "Sadie" is not read as "sad" nor "courage" as
+    "rage"; where two tokens start together the longer wins.
+    `aliases` maps other spellings ("John", "Watson") to the character they
+    stand for; a match on an alias is reported as that character."""
+
+    def __init__(self, potential_characters, aliases: dict = None):
+        self.characters = [char for char in potential_characters if char]
+        self._order = {char: index for index, char in enumerate(self.characters)}
+        self.aliases = {
+            alias: char for alias, char in (aliases or {}).items()
+            if alias and char in self._order
+        }
+        self._emotion_rank = {emotion: rank for rank, emotion in enumerate(EMOTION_KEYWORDS)}
+
+        # lowercased token -> list of (kind, value); kind is "name", "verb" or "emotion"
+        self._tokens = {}
+        for char in self.characters + list(self.aliases):
+            self._tokens.setdefault(char.lower(), []).append(("name", char))
+        for verb in ATTRIBUTION_VERBS:
+            self._tokens.setdefault(verb, []).append(("verb", verb))
+        for emotion, keywords in EMOTION_KEYWORDS.items():
+            for word in keywords:
+                self._tokens.setdefault(word, []).append(("emotion", emotion))
+        # Lookarounds rather than \b, since a name may start or end with punctuation ("J.")
+        self._pattern = re.compile(r"(?<!\w)" + _trie_pattern(self._tokens) + r"(?!\w)")
+        self._by_name = {char.casefold(): char for char in self.characters}
+        for alias, char in self.aliases.items():
+            self._by_name.setdefault(alias.casefold(), char)
+
+    def resolve(self, name: str):
+        """The character `name` (any case, or an alias) stands for, or None
+        if it is not in the cast."""
+        return self._by_name.get(name.casefold())
+
+    def scan(self, line: str) -> tuple:
+        """Returns (attributed names, speaker, leading name, emotions, verbs
+        outside quotes).
+
+        Attribution is looked for between the second and third double quote,
+        i.e. in `dialogue_parts[2]` of `line.split('"')`; the speaker is an
+        attributed name right next to an attribution verb ("said John", "John
+        said"), else None. The last item counts attribution verbs that are not
+        inside double quotes. Names come back in cast order and emotions in
+        priority order."""
+        quotes = [index for index, c in enumerate(line) if c == '"']
+        # (start, end) of each quoted stretch; an unclosed quote runs to the end
+        quoted = [(start + 1, end) for start, end in zip(quotes[::2], quotes[1::2] + [len(line)])]
+        after_start = after_end = -1
+        if len(quotes) >= 2:
+            after_start = quotes[1] + 1
+            after_end = quotes[2] if len(quotes) > 2 else len(line)
+
+        text = line.lower()
+        # Lowercasing a few non-ASCII characters changes the length; positions
+        # (and so name spelling checks) are only reliable when it doesn't
+        aligned = len(text) == len(line)
+
+        named = set()
+        leading_name = None
+        emotions = set()
+        verbs_outside = 0
+        # (start, end, kind, value) of the names and verbs in the attribution
+        attribution = []
+        for match in self._pattern.finditer(text):
+            position, token = match.start(), match.group()
+            in_attribution = after_start <= match.start() and match.end() <= after_end
+            for kind, value in self._tokens[token]:
+                if kind == "name":
+                    if aligned and line[position:match.end()] != value:
+                        continue
+                    value = self.aliases.get(value, value)
+                    if in_attribution:
+                        named.add(value)
+                        attribution.append((position, match.end(), kind, value))
+                    if position == 0 and leading_name is None:
+                        leading_name = value
+                    # A correctly spelled name is not also read as a keyword
+                    break
+                if kind == "verb":
+                    if not any(start <= position < end for start, end in quoted):
+                        verbs_outside += 1
+                    if in_attribution:
+                        attribution.append((position, match.end(), kind, value))
+                else:
+                    emotions.add(value)
+
+        speaker = None
+        for first, second in zip(attribution, attribution[1:]):
+            if {first[2], second[2]} == {"name", "verb"} and not text[first[1]:second[0]].strip():
+                speaker = first[3] if first[2] == "name" else second[3]
+                break
+
+        return (
+            sorted(named, key=self._order.get),
+            speaker,
+            leading_name,
+            sorted(emotions, key=self._emotion_rank.get),
+            verbs_outside
+        )
+
+
+def _local_tag(line: str, matcher: StoryMatcher) -> tuple:
+    """In-code guess of (character, emotion, confidence) for a line.
+
+    Pure narration and dialogue with a clear "..., said Name" attribution score
+    high enough to skip the model; anything ambiguous scores low and is
+    escalated. The guess is also the fallback when the model fails."""
+    character_name = "Narrator"
+    emotion = "neutral"
+
+    named, speaker, leading_name, matched_emotions, verbs_outside = matcher.scan(line)
+    if matched_emotions:
+        emotion = matched_emotions[0]
+
+    # Curly and single quotes are not parsed below, so never trust the guess for them
+    if "\u201c" in line or "\u201d" in line or _SINGLE_QUOTE.search(line):
+        return character_name, emotion, 0.3
+
+    if '"' not in line:
+        if verbs_outside:
+            # Speech without double quotes ("Run, John shouted.")
+            return character_name, emotion, 0.5
+        # Pure narration; only the emotion can be ambiguous
+        confidence = 0.9 if len(matched_emotions) <= 1 else 0.6
+        return character_name, emotion, confidence
+
+    # Simple dialogue detection: "text," said Character
+    confidence = 0.3
+    if speaker is not None:
+        character_name = speaker
+        # Another name or attribution verb may mean a second speaker
+        confidence = 0.9 if len(named) == 1 and verbs_outside == 1 else 0.5
+    elif named and verbs_outside:
+        # e.g. "Stop!" she shouted at John: John may be the one addressed
+        character_name = named[0]
+        confidence = 0.5
+    elif leading_name is not None and line.count('"') >= 2:
+        character_name = leading_name
+        confidence = 0.6
+
+    if len(matched_emotions) > 1:
+        confidence = min(confidence, 0.6)
+    return character_name, emotion, confidence
+
+
+def _record_tier(local: int, escalated: int):
+    """Updates the tier-0 counters exposed through tagging_metrics."""
+    with _metrics_lock:
+        tagging_metrics["lines_local"] += local
+        tagging_metrics["lines_escalated"] += escalated
+        tagging_metrics["lines_total"] += local + escalated
+        tagging_metrics["escalation_rate"] = round(
+            tagging_metrics["lines_escalated"] / tagging_metrics["lines_total"], 4
+        )
+
+
+def _is_title(line: str) -> bool:
+    return line.startswith("**") and line.endswith("**")
+
+
+def _tag_line(i: int, line: str, context: list, matcher: StoryMatcher, model_name: str, api_key: str) -> str:
+    """Tags a single line as <Character><emotion>"text".
+
+    `i` is the 1-based line number (for logging), `context` the neighbouring
+    lines sent along with the prompt and `matcher` the story's compiled cast."""
+    potential_characters = matcher.characters
+    # Handle title/formatting lines
+    if _is_title(line):
+        _record_tier(local=1, escalated=0)
+        print(f"✓ Processed line {i} as title")
+        return f"<Narrator><title>\"{line}\""
+
+    # Analyze for dialogue patterns directly in code
+    character_name, emotion, confidence = _local_tag(line, matcher)
+    if confidence >= LOCAL_TAG_THRESHOLD:
+        _record_tier(local=1, escalated=0)
+        line_result = f"<{character_name}><{emotion}>\"{line}\""
+        print(f"✓ Processed line {i} locally: {line_result[:50]}...")
+        return line_result
+    _record_tier(local=0, escalated=1)
+
+    # Reuse the tag from an earlier run on the same line and context
+    key = _cache_key(model_name, line, context, potential_characters)
+    cached = _cached_tag(key)
+    if cached is not None:
+        line_result = f"{cached}\"{line}\""
+        print(f"✓ Processed line {i} from cache: {line_result[:50]}...")
+        return line_result
+
+    # Try to use the AI for better analysis, with fallback to our basic detection
+    line_result = None
+    for attempt in range(3):
+        try:
+            # Enhanced prompt
+            prompt = (
+                "Analyze this story line to identify characters and emotions. Follow these rules EXACTLY:\n\n"
+                "1. CHARACTER IDENTIFICATION:\n"
+                "   - Use <Narrator> ONLY for narration that isn't dialogue or a character's thoughts\n"
+                "   - For dialogue, identify the specific character speaking\n"
+                f"   - Potential characters in this story include: {', '.join(potential_characters) if potential_characters else 'to be determined'}\n"
+                "   - Look for dialogue indicators like quotation marks, said/asked/replied, or changes in perspective\n\n"
+                "2. EMOTION TAGGING:\n"
+                "   - Tag the dominant emotion from: <neutral>, <joy>, <fear>, <anger>, <sadness>, <suspense>\n"
+                "   - Determine emotion from words used, context, punctuation, and actions described\n\n"
+                "3. FORMAT REQUIREMENTS:\n"
+                "   - Format as: <Character><emotion>\"text\" (NO EXTRA TEXT)\n"
+                "   - For chapter titles/formatting: <Narrator><title>\"text\"\n\n"
+                f"CONTEXT FROM STORY (if available):\n{context}\n\n"
+                f"LINE TO ANALYZE: \"{line}\"\n\n"
+                "PROVIDE ONLY THE TAGGED RESULT IN THE FORMAT <Character><emotion>\"text\". NO EXPLANATIONS."
+            )
+
+            line_result = _chat_completion(
+                model_name,
+                api_key,
+                [
+                    {"role": "system", "content": "You are a story analyzer that strictly follows tagging format rules."},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.2,
+                max_tokens=150
+            ).strip()
+
+            # Validate format
+            if not (line_result.startswith('<') and '>' in line_result and '"' in line_result):
+                raise ValueError(f"Invalid format received: {line_result}")
+
+            # Split at first quote to check if character and emotion are properly formatted
+            parts = line_result.split('"', 1)
+            tag_part = parts[0]
+
+            # Check if tag has both character and emotion
+            if tag_part.count('<') != 2 or tag_part.count('>') != 2:
+                raise ValueError(f"Tag format incorrect: {tag_part}")
+
+            _store_tag(key, tag_part.strip())
+            break  # Success
+
+        except Exception as e:
+            # Transport errors were already retried by the client; only a
+            # badly formatted reply is worth asking again
+            if attempt == 2 or isinstance(e, CircuitOpenError) or not isinstance(e, ValueError):
+                print(f"! Critical error on line {i}: {str(e)}")
+                line_result = f"<{character_name}><{emotion}>\"{line}\""
+                print(f"Using fallback tagging: {line_result[:50]}...")
+                break
+            print(f"Retrying line {i} after error: {str(e)}")
+
+    print(f"✓ Processed line {i}: {line_result[:50]}...")
+    return line_result
+
+
+def _tag_batch(start: int, batch: list, context: list, matcher: StoryMatcher, model_name: str, api_key: str) -> list:
+    """Tags a window of lines with one request per attempt.
+
+    `start` is the 1-based number of the first line in `batch` and `context` the
+    surrounding lines shared by the whole window. The model answers with a JSON
+    array of {line, character, emotion}; each line is validated on its own and
+    only the lines that failed are asked again. Once the cast is known, a
+    character outside it (other than the Narrator) counts as a failed line.
+    Lines still failing after three attempts fall back to the local tag."""
+    potential_characters = matcher.characters
+    results = [None] * len(batch)
+    for offset, line in enumerate(batch):
+        if _is_title(line):
+            results[offset] = f"<Narrator><title>\"{line}\""
+            continue
+        # Confident local tags never reach the model
+        character_name, emotion, confidence = _local_tag(line, matcher)
+        if confidence >= LOCAL_TAG_THRESHOLD:
+            results[offset] = f"<{character_name}><{emotion}>\"{line}\""
+    escalated = sum(result is None for result in results)
+    _record_tier(local=len(batch) - escalated, escalated=escalated)
+
+    # Cache keys use each line's own lines[i-2:i+3] window, as in per-line mode
+    lead = min(2, start - 1)
+    keys = {}
+    for offset, line in enumerate(batch):
+        if results[offset] is None:
+            window = context[max(0, lead + offset - 2):lead + offset + 3]
+            keys[offset] = _cache_key(model_name, line, window, potential_characters)
+            cached = _cached_tag(keys[offset])
+            if cached is not None:
+                results[offset] = f"{cached}\"{line}\""
+
+    for attempt in range(3):
+        pending = [offset for offset, result in enumerate(results) if result is None]
+        if not pending:
+            break
+
+        try:
+            numbered = "\n".join(f"{start + offset}. {batch[offset]}" for offset in pending)
+            prompt = (
+                "Analyze these story lines to identify characters and emotions. Follow these rules EXACTLY:\n\n"
+                "1. CHARACTER IDENTIFICATION:\n"
+                "   - Use Narrator ONLY for narration that isn't dialogue or a character's thoughts\n"
+                "   - For dialogue, identify the specific character speaking\n"
+                f"   - Potential characters in this story include: {', '.join(potential_characters) if potential_characters else 'to be determined'}\n"
+                "   - Look for dialogue indicators like quotation marks, said/asked/replied, or changes in perspective\n\n"
+                "2. EMOTION TAGGING:\n"
+                f"   - Tag the dominant emotion from: {', '.join(EMOTIONS)}\n"
+                "   - Determine emotion from words used, context, punctuation, and actions described\n\n"
+                "3. FORMAT REQUIREMENTS:\n"
+                "   - Respond with ONLY a JSON array, one object per numbered line, in order\n"
+                "   - Each object must be {\"line\": number, \"character\": string, \"emotion\": string}\n\n"
+                f"CONTEXT FROM STORY (if available):\n{context}\n\n"
+                f"LINES TO ANALYZE:\n{numbered}\n\n"
+                "PROVIDE ONLY THE JSON ARRAY. NO EXPLANATIONS."
+            )
+
+            response_text = _chat_completion(
+                model_name,
+                api_key,
+                [
+                    {"role": "system", "content": "You are a story analyzer that strictly follows tagging format rules."},
+                    {"role": "user", "content": prompt}
+                ],
+                temperature=0.2,
+                max_tokens=50 + 40 * len(pending)
+            )
+
+            json_match = re.search(r'\[[\s\S]*\]', response_text)
+            if not json_match:
+                raise ValueError(f"No JSON array received: {response_text[:100]}")
+            entries = json.loads(json_match.group())
+            if not isinstance(entries, list):
+                raise ValueError(f"Invalid format received: {response_text[:100]}")
+
+            # Match entries to lines by their number, falling back to position
+            by_number = {}
+            for position, entry in enumerate(entries):
+                if not isinstance(entry, dict):
+                    continue
+                number = entry.get("line")
+                if not isinstance(number, int) and position < len(pending):
+                    number = start + pending[position]
+                by_number[number] = entry
+
+            for offset in pending:
+                entry = by_number.get(start + offset)
+                if entry is None:
+                    continue
+                character = str(entry.get("character", "")).strip().strip("<>")
+                emotion = str(entry.get("emotion", "")).strip().strip("<>").lower()
+                if not character or any(c in character for c in '<>"') or emotion not in EMOTIONS:
+                    print(f"Invalid tag for line {start + offset}: {entry}")
+                    continue
+                if character.casefold() == "narrator":
+                    character = "Narrator"
+                elif potential_characters:
+                    known = matcher.resolve(character)
+                    if known is None:
+                        print(f"Unknown character for line {start + offset}: {entry}")
+                        continue
+                    character = known
+                results[offset] = f"<{character}><{emotion}>\"{batch[offset]}\""
+                _store_tag(keys[offset], f"<{character}><{emotion}>")
+
+            failed = sum(result is None for result in results)
+            if failed and attempt < 2:
+                print(f"Retrying {failed} line(s) of batch starting at line {start}")
+
+        except ValueError as e:
+            # json.JSONDecodeError is a ValueError too
+            if attempt < 2:
+                print(f"Retrying batch starting at line {start} after error: {str(e)}")
+            else:
+                print(f"! Critical error on batch starting at line {start}: {str(e)}")
+        except Exception as e:
+            # Transport errors were already retried by the client
+            print(f"! Critical error on batch starting at line {start}: {str(e)}")
+            break
+
+    for offset, line in enumerate(batch):
+        if results[offset] is None:
+            character_name, emotion, _ = _local_tag(line, matcher)
+            results[offset] = f"<{character_name}><{emotion}>\"{line}\""
+            print(f"Using fallback tagging for line {start + offset}: {results[offset][:50]}...")
+
+    print(f"✓ Processed lines {start}-{start + len(batch) - 1}")
+    return results
+
+
+def _save_tagged_story(analysis: str) -> str:
+    """Saves the tagged story under stories/ and returns the file name."""
+    os.makedirs("stories", exist_ok=True)
+    timestamp = int(time.time())
+    filename = f"stories/tagged_story_{timestamp}.txt"
+    with open(filename, "w", encoding="utf-8") as f:
+        f.write(analysis)
+    print(f"Tagged story saved to {filename}")
+    return filename
+
+
+def _log_tagging_error(e: Exception, story: str):
+    print(f"Error in story analysis: {str(e)}")
+    os.makedirs("stories", exist_ok=True)
+    with open("stories/tagging_error.log", "w", encoding="utf-8") as f:
+        f.write(f"Error: {str(e)}\n\nInput story (first 1000 chars):\n{story[:1000]}...")
+
+
 def analyze_and_tag_story(
     story: str,
-    api_key: str = os.getenv("OPENAI_API_KEY"),   
-    model_name: str = "gpt-4"   
+    api_key: str = os.getenv("OPENAI_API_KEY"),
+    model_name: str = "gpt-4",
+    batch_size: int = TAGGING_BATCH_SIZE,
+    max_concurrency: int = TAGGING_WORKERS
 ) -> str:
     """Processes a story to tag characters, narration, and emotions in each line.
     Saves the tagged result in a file and returns the tagged content as a string.
+    With batch_size > 0, lines are tagged in windows of that size per request.
+    Up to max_concurrency requests run at once; results keep the story order.
     Returns None if something fails."""
-    
-    try:
-        openai.api_key = api_key   
 
+    try:
         lines = [line.strip() for line in story.split("\n") if line.strip()]
         if not lines:
             raise ValueError("Empty story input")
-        
+
         results = []
         total_lines = len(lines)
-        
-        # First, scan the story to extract potential character names
-        story_text = "\n".join(lines)
-        potential_characters = []
-        
-        try:
-            character_scan_prompt = (
-                "Extract ALL character names from this story excerpt. Only respond with a comma-separated list of names.\n"
-                "Look for:\n"
-                "1. Names in dialogue tags (e.g., \"Hello,\" said John)\n"
-                "2. Names mentioned in conversation\n"
-                "3. Names of anyone performing actions\n\n"
-                f"STORY EXCERPT:\n{story_text}"  
-            )
-            
-            char_response = openai.ChatCompletion.create(  
-                model=model_name,
-                messages=[
-                    {"role": "system", "content": "You are a character name extractor. Only respond with a comma-separated list of names."},
-                    {"role": "user", "content": character_scan_prompt}
-                ],
-                temperature=0.2,
-                max_tokens=150
+
+        with ThreadPoolExecutor(max_workers=max(max_concurrency, 1)) as executor:
+            # First, scan the story (in chunks if it is long) for potential character names
+            potential_characters, aliases = _merge_character_names(
+                _scan_characters_chunked(lines, model_name, api_key, executor)
             )
-            potential_characters = [name.strip() for name in char_response.choices[0].message.content.split(',')]
             print(f"Identified potential characters: {potential_characters}")
-        except Exception as e:
-            print(f"Warning: Character scan failed: {e}. Proceeding with standard processing.")
-        
-        # Process each line
-        for i, line in enumerate(lines, 1):
-            print(f"Processing line {i}/{total_lines}: {line[:50]}...")
-
-            # Handle title/formatting lines
-            if line.startswith("**") and line.endswith("**"):
-                results.append(f"<Narrator><title>\"{line}\"")
-                print(f"✓ Processed line {i} as title")
-                continue
-            
-            # Analyze for dialogue patterns directly in code
-            character_name = "Narrator"
-            emotion = "neutral"
-            
-            # Simple dialogue detection
-            if '"' in line:
-                # Check for dialogue attribution patterns like "text," said Character
-                dialogue_parts = line.split('"')
-                
-                if len(dialogue_parts) >= 3:
-                    after_quote = dialogue_parts[2].strip()
-                    
-                    # Check dialogue attribution patterns
-                    for char in potential_characters:
-                        if char in after_quote and any(word in after_quote.lower() for word in ["said", "asked", "replied", "whispered", "shouted", "exclaimed"]):
-                            character_name = char
-                            break
-                     
-                    if character_name == "Narrator":
-                        for char in potential_characters:
-                            if line.startswith(char):
-                                character_name = char
-                                break
-                
-                # Basic emotion detection
-                text = line.lower()
-                if any(word in text for word in ["happy", "laugh", "smile", "joy", "grin", "delighted"]):
-                    emotion = "joy"
-                elif any(word in text for word in ["afraid", "fear", "terrified", "scared", "trembling"]):
-                    emotion = "fear"  
-                elif any(word in text for word in ["angry", "furious", "rage", "yelled", "snapped"]):
-                    emotion = "anger"
-                elif any(word in text for word in ["sad", "tears", "cried", "sorrow", "grief"]):
-                    emotion = "sadness"
-                elif any(word in text for word in ["suspense", "tense", "uncertain", "waited"]):
-                    emotion = "suspense"
-            
-            # Try to use the AI for better analysis, with fallback to our basic detection
-            line_result = None
-            for attempt in range(3):
-                try:
-                    # Enhanced prompt
-                    prompt = (
-                        "Analyze this story line to identify characters and emotions. Follow these rules EXACTLY:\n\n"
-                        "1. CHARACTER IDENTIFICATION:\n"
-                        "   - Use <Narrator> ONLY for narration that isn't dialogue or a character's thoughts\n"
-                        "   - For dialogue, identify the specific character speaking\n"
-                        f"   - Potential characters in this story include: {', '.join(potential_characters) if potential_characters else 'to be determined'}\n"
-                        "   - Look for dialogue indicators like quotation marks, said/asked/replied, or changes in perspective\n\n"
-                        "2. EMOTION TAGGING:\n"
-                        "   - Tag the dominant emotion from: <neutral>, <joy>, <fear>, <anger>, <sadness>, <suspense>\n"
-                        "   - Determine emotion from words used, context, punctuation, and actions described\n\n"
-                        "3. FORMAT REQUIREMENTS:\n"
-                        "   - Format as: <Character><emotion>\"text\" (NO EXTRA TEXT)\n"
-                        "   - For chapter titles/formatting: <Narrator><title>\"text\"\n\n"
-                        f"CONTEXT FROM STORY (if available):\n{lines[max(0, i-3):min(total_lines, i+2)]}\n\n"
-                        f"LINE TO ANALYZE: \"{line}\"\n\n"
-                        "PROVIDE ONLY THE TAGGED RESULT IN THE FORMAT <Character><emotion>\"text\". NO EXPLANATIONS."
-                    )
-
-                    response = openai.ChatCompletion.create(  
-                        model=model_name,
-                        messages=[
-                            {"role": "system", "content": "You are a story analyzer that strictly follows tagging format rules."},
-                            {"role": "user", "content": prompt}
-                        ],
-                        temperature=0.2,
-                        max_tokens=150
-                    )
-
-                    line_result = response.choices[0].message.content.strip()
-
-                    # Validate format
-                    if not (line_result.startswith('<') and '>' in line_result and '"' in line_result):
-                        raise ValueError(f"Invalid format received: {line_result}")
-
-                    # Split at first quote to check if character and emotion are properly formatted
-                    parts = line_result.split('"', 1)
-                    tag_part = parts[0]
-                    
-                    # Check if tag has both character and emotion
-                    if tag_part.count('<') != 2 or tag_part.count('>') != 2:
-                        raise ValueError(f"Tag format incorrect: {tag_part}")
-
-                    break  # Success
 
-                except Exception as e:
-                    if attempt == 2:
-                        print(f"! Critical error on line {i}: {str(e)}") 
-                        line_result = f"<{character_name}><{emotion}>\"{line}\""
-                        print(f"Using fallback tagging: {line_result[:50]}...")
-                    else:
-                        print(f"Retrying line {i} after error: {str(e)}")
-                        time.sleep(2 ** attempt)
+            # Compile the cast and keyword lists once for the whole story
+            matcher = StoryMatcher(potential_characters, aliases)
+
+            # Lines only depend on their raw neighbours, so they can be tagged concurrently
+            futures = []
+            if batch_size > 0:
+                # Process windows of lines, sharing the surrounding context
+                for start in range(0, total_lines, batch_size):
+                    batch = lines[start:start + batch_size]
+                    print(f"Processing lines {start + 1}-{start + len(batch)}/{total_lines}...")
+                    context = lines[max(0, start - 2):min(total_lines, start + len(batch) + 2)]
+                    futures.append(executor.submit(
+                        _tag_batch, start + 1, batch, context, matcher, model_name, api_key
+                    ))
+            else:
+                # Process each line
+                for i, line in enumerate(lines, 1):
+                    print(f"Processing line {i}/{total_lines}: {line[:50]}...")
+                    context = lines[max(0, i-3):min(total_lines, i+2)]
+                    futures.append(executor.submit(
+                        lambda *args: [_tag_line(*args)], i, line, context, matcher, model_name, api_key
+                    ))
+
+            # Reassemble in story order
+            for future in futures:
+                results.extend(future.result())
+
 
-            results.append(line_result)
-            print(f"✓ Processed line {i}: {line_result[:50]}...")
-  
- 
         analysis = "\n".join(results)
         print(f"\nSuccessfully processed {len(results)}/{total_lines} lines")
 
         # Save the result to a file
-        os.makedirs("stories", exist_ok=True)
-        timestamp = int(time.time())
-        filename = f"stories/tagged_story_{timestamp}.txt"
-        with open(filename, "w", encoding="utf-8") as f:
-            f.write(analysis)
-        print(f"Tagged story saved to {filename}")
+        _save_tagged_story(analysis)
 
         return analysis
 
     except Exception as e:
-        print(f"Error in story analysis: {str(e)}")
-        os.makedirs("stories", exist_ok=True)
-        with open("stories/tagging_error.log", "w", encoding="utf-8") as f:
-            f.write(f"Error: {str(e)}\n\nInput story (first 1000 chars):\n{story[:1000]}...")
-        return None
\ No newline at end of file
+        _log_tagging_error(e, story)
+        return None
+
+
+def analyze_and_tag_story_stream(
+    story_chunks,
+    api_key: str = os.getenv("OPENAI_API_KEY"),
+    model_name: str = "gpt-4",
+    max_concurrency: int = TAGGING_WORKERS,
+    batch_size: int = TAGGING_BATCH_SIZE
+) -> tuple:
+    """Tags a story while it is still being generated.
+
+    `story_chunks` is an iterable of story chunks (e.g. `generate_story_chunks`).
+    It is drained on a producer thread while tagging workers pick up each line
+    as soon as the two lines after it (its context window) have arrived.
+    With batch_size > 0, workers receive windows of that many lines instead.
+    If tagging fails the producer stops asking for chunks, so no more story
+    sections are generated for nobody to read.
+    Returns (story, tagged_story); tagged_story is None if tagging fails."""
+
+    chunk_queue = queue.Queue()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            for chunk in story_chunks:
+                if stop.is_set():
+                    break
+                chunk_queue.put(chunk)
+        except Exception as e:
+            print(f"Error while generating story chunks: {e}")
+        finally:
+            # Ends a generator before it makes its next model call
+            if hasattr(story_chunks, "close"):
+                story_chunks.close()
+            chunk_queue.put(None)
+
+    producer = threading.Thread(target=produce, daemon=True)
+    producer.start()
+
+    story = ""
+    lines = []
+    futures = []
+    scanned_names = []
+    potential_characters = []
+    matcher = StoryMatcher(potential_characters)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(max_concurrency, 1)) as executor:
+
+            submitted = 0
+
+            def submit_ready(finished):
+                nonlocal submitted
+                size = max(batch_size, 1)
+                # A window needs the two lines after it as context, so wait for them
+                while submitted < len(lines) and (finished or submitted + size + 2 <= len(lines)):
+                    end = min(submitted + size, len(lines))
+                    context = lines[max(0, submitted - 2):end + 2]
+                    if batch_size > 0:
+                        futures.append(executor.submit(
+                            _tag_batch, submitted + 1, lines[submitted:end], context,
+                            matcher, model_name, api_key
+                        ))
+                    else:
+                        futures.append(executor.submit(
+                            lambda *args: [_tag_line(*args)], submitted + 1, lines[submitted], context,
+                            matcher, model_name, api_key
+                        ))
+                    submitted = end
+
+            while True:
+                chunk = chunk_queue.get()
+                if chunk is None:
+                    break
+                story += "\n\n" + chunk
+
+                # Extend the character list with names introduced in this chunk
+                try:
+                    scanned_names.extend(_scan_characters(chunk, model_name, api_key))
+                    characters, aliases = _merge_character_names(scanned_names)
+                    if characters != matcher.characters or aliases != matcher.aliases:
+                        potential_characters = characters
+                        matcher = StoryMatcher(potential_characters, aliases)
+                    print(f"Identified potential characters: {potential_characters}")
+                except Exception as e:
+                    print(f"Warning: Character scan failed: {e}. Proceeding with standard processing.")
+
+                lines.extend(line.strip() for line in chunk.split("\n") if line.strip())
+                submit_ready(finished=False)
+
+            if not lines:
+                raise ValueError("Empty story input")
+            submit_ready(finished=True)
+            results = [result for future in futures for result in future.result()]
+
+        analysis = "\n".join(results)
+        print(f"\nSuccessfully processed {len(results)}/{len(lines)} lines")
+        _save_tagged_story(analysis)
+        return story, analysis
+
+    except Exception as e:
+        _log_tagging_error(e, story)
+        return story, None
+    finally:
+        stop.set()
+        producer.join()
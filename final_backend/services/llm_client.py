@@ -0,0 +1,362 @@
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import types
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import httpx
+from openai import OpenAI
+from dotenv import load_dotenv
+from services.metrics import latency_summary
+from services.rate_limiter import estimate_tokens
+
+load_dotenv()
+
+# Connections kept open to the provider and shared by every caller
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "120"))
+# Attempts after the first one for timeouts, rate limits and 5xx errors
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "1.0"))
+LLM_BACKOFF_MAX = float(os.getenv("LLM_BACKOFF_MAX", "20"))
+# Send a duplicate request if the first has not answered after this many
+# seconds, and use whichever finishes first (0 disables hedging)
+LLM_HEDGE_AFTER = float(os.getenv("LLM_HEDGE_AFTER", "0"))
+# Consecutive failed attempts before calls fail fast, and for how long
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_COOLDOWN = float(os.getenv("LLM_BREAKER_COOLDOWN", "30"))
+
+# "live" calls the provider, "record" also saves every response, "replay"
+# serves saved responses only and never touches the network
+LLM_MODE = os.getenv("LLM_MODE", "live")
+LLM_CASSETTE_DIR = os.getenv("LLM_CASSETTE_DIR", "cache/llm_cassettes")
+# Delay added to replayed responses: "recorded" reuses the latency seen when
+# recording, a number of seconds fixes it (0 answers immediately)
+LLM_REPLAY_LATENCY = os.getenv("LLM_REPLAY_LATENCY", "recorded")
+# Point the client at an OpenAI-compatible server instead, e.g. llm_replay_server.py
+LLM_BASE_URL = os.getenv("LLM_BASE_URL") or None
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling the provider while the circuit breaker is open."""
+
+
+class ReplayMissError(Exception):
+    """Raised in replay mode for a request that was never recorded."""
+
+
+class CassetteStore:
+    """Recorded chat completions on disk, one JSON file per request.
+
+    Files are named by a hash of the request body (model, messages and
+    sampling parameters, but not the API key), so the same request made by
+    any service finds the same recording."""
+
+    def __init__(self, directory: str = LLM_CASSETTE_DIR, latency: str = LLM_REPLAY_LATENCY):
+        self.directory = directory
+        self.latency = latency
+
+    @staticmethod
+    def key(request: dict) -> str:
+        payload = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, request: dict) -> str:
+        return os.path.join(self.directory, self.key(request) + ".json")
+
+    def save(self, request: dict, response, latency: float):
+        usage = getattr(response, "usage", None)
+        entry = {
+            "request": request,
+            "content": response.choices[0].message.content,
+            "finish_reason": getattr(response.choices[0], "finish_reason", "stop"),
+            "usage": {
+                "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+                "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+            },
+            "latency": round(latency, 3),
+        }
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path(request)
+        # Write then rename, so concurrent readers never see half a file
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, path)
+
+    def load(self, request: dict) -> dict:
+        """Returns the recorded entry for a request, or None."""
+        try:
+            with open(self._path(request), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def delay(self, entry: dict) -> float:
+        if self.latency == "recorded":
+            return entry.get("latency", 0.0)
+        return float(self.latency)
+
+    def replay(self, request: dict):
+        """Returns the recorded response, shaped like the SDK's, after the simulated delay."""
+        entry = self.load(request)
+        if entry is None:
+            raise ReplayMissError(
+                f"No recorded response for request {self.key(request)[:12]} in {self.directory}; "
+                "run once with LLM_MODE=record"
+            )
+        time.sleep(self.delay(entry))
+        return types.SimpleNamespace(
+            choices=[types.SimpleNamespace(
+                message=types.SimpleNamespace(role="assistant", content=entry["content"]),
+                finish_reason=entry.get("finish_reason", "stop")
+            )],
+            usage=types.SimpleNamespace(
+                prompt_tokens=entry["usage"]["prompt_tokens"],
+                completion_tokens=entry["usage"]["completion_tokens"],
+                total_tokens=entry["usage"]["prompt_tokens"] + entry["usage"]["completion_tokens"]
+            )
+        )
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures and rejects calls for
+    `cooldown` seconds. After that a single trial call is let through; its
+    outcome closes the breaker again or restarts the cooldown."""
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self._trial_running = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.cooldown:
+            return "open"
+        return "half-open"
+
+    def before_call(self):
+        with self._lock:
+            state = self.state
+            if state == "open" or (state == "half-open" and self._trial_running):
+                raise CircuitOpenError("LLM provider circuit is open; failing fast")
+            if state == "half-open":
+                self._trial_running = True
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial_running or (self.threshold and self.failures >= self.threshold):
+                self.opened_at = time.monotonic()
+            self._trial_running = False
+
+
+def is_retryable(error: Exception) -> bool:
+    """Timeouts, dropped connections, rate limits and server errors are worth retrying."""
+    if isinstance(error, (httpx.TimeoutException, httpx.TransportError)):
+        return True
+    status = getattr(error, "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS
+    # openai's APIConnectionError/APITimeoutError carry no status code
+    return type(error).__name__ in ("APIConnectionError", "APITimeoutError")
+
+
+class LLMClient:
+    """One chat-completions client for the whole backend.
+
+    All requests go over a single pooled httpx connection pool, so TLS
+    connections are reused between calls and threads. Retries (exponential
+    backoff with full jitter), optional hedging and the circuit breaker are
+    handled here; the SDK's own retries are turned off. Latency and token
+    usage of every call are collected in `metrics()`.
+
+    With mode="record" every successful response is also written to
+    `cassettes`; with mode="replay" responses come only from there."""
+
+    def __init__(
+        self,
+        max_connections: int = LLM_MAX_CONNECTIONS,
+        timeout: float = LLM_TIMEOUT,
+        max_retries: int = LLM_MAX_RETRIES,
+        hedge_after: float = LLM_HEDGE_AFTER,
+        breaker: CircuitBreaker = None,
+        mode: str = LLM_MODE,
+        cassettes: CassetteStore = None
+    ):
+        if mode not in ("live", "record", "replay"):
+            raise ValueError(f"Unknown LLM mode: {mode}")
+        self.mode = mode
+        self.cassettes = cassettes or CassetteStore()
+        self.max_retries = max_retries
+        self.hedge_after = hedge_after
+        self.breaker = breaker or CircuitBreaker(LLM_BREAKER_THRESHOLD, LLM_BREAKER_COOLDOWN)
+        self._http = httpx.Client(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections),
+            timeout=timeout
+        )
+        self._clients = {}
+        self._hedge_pool = None
+        self._lock = threading.Lock()
+
+        self._latencies = deque(maxlen=1000)
+        self._metrics = {
+            "calls": 0,
+            "failures": 0,
+            "retries": 0,
+            "hedges": 0,
+            "hedge_wins": 0,
+            "rejected_by_breaker": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+        }
+
+    def _client(self, api_key: str) -> OpenAI:
+        api_key = api_key or os.getenv("OPENAI_API_KEY")
+        with self._lock:
+            if api_key not in self._clients:
+                self._clients[api_key] = OpenAI(
+                    api_key=api_key, base_url=LLM_BASE_URL, http_client=self._http, max_retries=0
+                )
+            return self._clients[api_key]
+
+    def _count(self, name: str, amount: int = 1):
+        with self._lock:
+            self._metrics[name] += amount
+
+    @staticmethod
+    def _acquire(rate_limiter, kwargs: dict):
+        if rate_limiter is not None:
+            rate_limiter.acquire(estimate_tokens(kwargs["messages"], kwargs.get("max_tokens") or 0))
+
+    def _send(self, client: OpenAI, kwargs: dict, rate_limiter):
+        self._acquire(rate_limiter, kwargs)
+        return client.chat.completions.create(**kwargs)
+
+    def _attempt(self, client: OpenAI, kwargs: dict, rate_limiter=None):
+        """One request, or two if hedging is on and the first is slow. Each
+        request sent takes its own share of `rate_limiter`."""
+        if not self.hedge_after:
+            return self._send(client, kwargs, rate_limiter)
+
+        with self._lock:
+            if self._hedge_pool is None:
+                self._hedge_pool = ThreadPoolExecutor(max_workers=LLM_MAX_CONNECTIONS)
+        # Wait for the limiter before starting the hedge timer
+        self._acquire(rate_limiter, kwargs)
+        first = self._hedge_pool.submit(client.chat.completions.create, **kwargs)
+        done, _ = wait([first], timeout=self.hedge_after)
+        if done:
+            return first.result()
+
+        self._count("hedges")
+        second = self._hedge_pool.submit(self._send, client, kwargs, rate_limiter)
+        pending = {first, second}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    for other in pending:
+                        other.cancel()
+                    if future is second:
+                        self._count("hedge_wins")
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def chat(self, messages: list, model: str = "gpt-4", api_key: str = None, rate_limiter=None, **kwargs):
+        """Creates a chat completion and returns the SDK response object.
+
+        With a `rate_limiter` (services.rate_limiter.TokenBucketRateLimiter)
+        every request actually sent, retries and hedges included, waits for
+        one request and its estimated tokens from it.
+
+        Raises CircuitOpenError without calling the provider while the breaker
+        is open, the provider's error once retries are used up, and
+        ReplayMissError in replay mode for a request with no recording."""
+        kwargs = dict(kwargs, model=model, messages=messages)
+        if self.mode == "replay":
+            started = time.monotonic()
+            response = self.cassettes.replay(kwargs)
+            self._record_call(time.monotonic() - started, response)
+            return response
+
+        client = self._client(api_key)
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.breaker.before_call()
+            except CircuitOpenError:
+                self._count("rejected_by_breaker")
+                raise
+
+            started = time.monotonic()
+            try:
+                response = self._attempt(client, kwargs, rate_limiter)
+            except Exception as e:
+                retryable = is_retryable(e)
+                if retryable:
+                    self.breaker.record_failure()
+                else:
+                    # A bad request says nothing about provider health
+                    self.breaker.record_success()
+                if not retryable or attempt == self.max_retries:
+                    self._count("failures")
+                    raise
+                self._count("retries")
+                delay = random.uniform(0, min(LLM_BACKOFF_MAX, LLM_BACKOFF_BASE * 2 ** attempt))
+                print(f"⚠️ LLM call failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+
+            latency = time.monotonic() - started
+            self.breaker.record_success()
+            self._record_call(latency, response)
+            if self.mode == "record":
+                try:
+                    self.cassettes.save(kwargs, response, latency)
+                except Exception as e:
+                    print(f"⚠️ Failed to record LLM response: {e}")
+            return response
+
+    def _record_call(self, latency: float, response):
+        usage = getattr(response, "usage", None)
+        with self._lock:
+            self._latencies.append(latency)
+            self._metrics["calls"] += 1
+            if usage is not None:
+                self._metrics["prompt_tokens"] += usage.prompt_tokens or 0
+                self._metrics["completion_tokens"] += usage.completion_tokens or 0
+
+    def chat_text(self, messages: list, model: str = "gpt-4", api_key: str = None, rate_limiter=None, **kwargs) -> str:
+        """Like chat(), but returns only the reply text."""
+        return self.chat(messages, model=model, api_key=api_key, rate_limiter=rate_limiter,
+                         **kwargs).choices[0].message.content
+
+    def metrics(self) -> dict:
+        with self._lock:
+            latencies = list(self._latencies)
+            metrics = dict(self._metrics)
+        metrics["mode"] = self.mode
+        metrics["breaker_state"] = self.breaker.state
+        metrics.update(latency_summary(latencies))
+        return metrics
+
+
+llm = LLMClient()
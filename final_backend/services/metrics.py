@@ -0,0 +1,15 @@
+# Summaries shared by the services' /...-metrics endpoints
+
+
+def latency_summary(durations, name: str = "latency") -> dict:
+    """Average, median and 95th percentile of `durations` (seconds), rounded
+    to the millisecond, as {name}_avg_s, {name}_p50_s and {name}_p95_s.
+    Empty when there are no durations yet."""
+    durations = sorted(durations)
+    if not durations:
+        return {}
+    return {
+        f"{name}_avg_s": round(sum(durations) / len(durations), 3),
+        f"{name}_p50_s": round(durations[len(durations) // 2], 3),
+        f"{name}_p95_s": round(durations[min(len(durations) - 1, int(len(durations) * 0.95))], 3),
+    }
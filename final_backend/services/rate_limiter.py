@@ -0,0 +1,51 @@
+import threading
+import time
+
+
+class TokenBucketRateLimiter:
+    """Thread-safe token buckets for provider requests-per-minute and
+    tokens-per-minute limits. A limit of 0 disables that bucket."""
+
+    def __init__(self, rpm: int = 0, tpm: int = 0):
+        self.rpm = rpm
+        self.tpm = tpm
+        self._requests = float(rpm)
+        self._tokens = float(tpm)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        if self.rpm:
+            self._requests = min(self.rpm, self._requests + elapsed * self.rpm / 60)
+        if self.tpm:
+            self._tokens = min(self.tpm, self._tokens + elapsed * self.tpm / 60)
+
+    def acquire(self, tokens: int = 0):
+        """Blocks until one request and `tokens` tokens can be spent."""
+        if self.tpm:
+            # A single request can never need more than the whole bucket
+            tokens = min(tokens, self.tpm)
+
+        while True:
+            with self._lock:
+                self._refill()
+                wait = 0.0
+                if self.rpm and self._requests < 1:
+                    wait = max(wait, (1 - self._requests) * 60 / self.rpm)
+                if self.tpm and self._tokens < tokens:
+                    wait = max(wait, (tokens - self._tokens) * 60 / self.tpm)
+                if wait == 0.0:
+                    if self.rpm:
+                        self._requests -= 1
+                    if self.tpm:
+                        self._tokens -= tokens
+                    return
+            time.sleep(wait)
+
+
+def estimate_tokens(messages: list, max_tokens: int = 0) -> int:
+    """Rough token count of a chat request (~4 characters per token)."""
+    return sum(len(message["content"]) for message in messages) // 4 + max_tokens
@@ -1,50 +1,254 @@
-import whisper
 import os
-import tempfile
+import time
+import queue
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from fastapi import HTTPException
 from typing import Optional
+from services.asr import AudioStreamDecoder, asr_from_env
+from services.metrics import latency_summary
+
+try:
+    from python_multipart.multipart import MultipartParser, parse_options_header
+except ImportError:  # python-multipart < 0.0.13
+    from multipart.multipart import MultipartParser, parse_options_header
+
+# Resident Whisper models, i.e. transcriptions that can run at once; 0 loads
+# none and turns transcription off
+STT_WORKERS = int(os.getenv("STT_WORKERS", "1"))
+# Requests allowed to wait for a free model before new ones get a 503
+STT_MAX_QUEUE = int(os.getenv("STT_MAX_QUEUE", "8"))
+
+MAX_UPLOAD_BYTES = 10 * 1024 * 1024  # 10MB
+VALID_EXTENSIONS = (".mp3", ".wav", ".m4a", ".ogg", ".flac", ".webm")
+
+
+class _UploadField:
+    """Parses a multipart/form-data body as it is written and picks out one
+    file field: `filename` is set as soon as that part's headers are parsed,
+    and its bytes collect in `take()` as they arrive."""
+
+    def __init__(self, boundary: bytes, field: str):
+        self.field = field.encode()
+        self.filename = None
+        self._pending = []
+        self._in_field = False
+        self._headers = {}
+        self._header_field = b""
+        self._header_value = b""
+        self._parser = MultipartParser(boundary, callbacks={
+            "on_part_begin": self._on_part_begin,
+            "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value,
+            "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+            "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end,
+        })
+
+    def _on_part_begin(self):
+        self._headers = {}
+
+    def _on_header_field(self, data, start, end):
+        self._header_field += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._header_value += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header_field.lower()] = self._header_value
+        self._header_field = self._header_value = b""
+
+    def _on_headers_finished(self):
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        # Only the first part with the field's name is used
+        if options.get(b"name") == self.field and self.filename is None:
+            self.filename = options.get(b"filename", b"").decode(errors="ignore")
+            self._in_field = True
+
+    def _on_part_data(self, data, start, end):
+        if self._in_field:
+            self._pending.append(bytes(data[start:end]))
+
+    def _on_part_end(self):
+        self._in_field = False
+
+    def write(self, chunk: bytes):
+        self._parser.write(chunk)
+
+    def finalize(self):
+        self._parser.finalize()
+
+    def take(self) -> list:
+        pending, self._pending = self._pending, []
+        return pending
+
 
 class SpeechToText:
-    def __init__(self, model_size: str = "tiny"):
+    def __init__(
+        self,
+        model_size: str = "tiny",
+        workers: int = STT_WORKERS,
+        max_queue: int = STT_MAX_QUEUE,
+        asr_factory=None
+    ):
+        self.workers = max(workers, 1)
+        self.max_queue = max_queue
+        # The backend is picked with STT_ASR_BACKEND etc. (see services/asr.py)
+        asr_factory = asr_factory or (lambda: asr_from_env("STT", default_model=model_size))
         try:
-            self.model = whisper.load_model(model_size)
+            # One model per worker; a model instance is never shared between threads
+            self._models = queue.Queue()
+            for _ in range(self.workers):
+                self._models.put(asr_factory())
         except Exception as e:
             raise RuntimeError(f"Error loading Whisper model: {e}")
 
-    async def transcribe_audio(self, audio_file) -> str:
-        """Convert speech in an audio file to text"""
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="whisper")
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        self._latencies = deque(maxlen=1000)
+        self._waits = deque(maxlen=1000)
+        self._counts = {"requests": 0, "rejected": 0, "failed": 0}
+
+    def _admit(self):
+        """Reserves a slot for one request, or rejects it when the queue is full."""
+        with self._lock:
+            if self._in_flight >= self.workers + self.max_queue:
+                self._counts["rejected"] += 1
+                raise HTTPException(
+                    status_code=503,
+                    detail="Transcription service is busy, please retry shortly",
+                    headers={"Retry-After": "5"}
+                )
+            self._in_flight += 1
+            self._counts["requests"] += 1
+
+    def _release(self, started: float, failed: bool):
+        with self._lock:
+            self._in_flight -= 1
+            self._latencies.append(time.monotonic() - started)
+            if failed:
+                self._counts["failed"] += 1
+
+    def _submit(self, audio, started: float) -> asyncio.Future:
+        """Queues an admitted request on the pool and returns an awaitable for its text.
+
+        The slot is released when the worker is done with it, not when the
+        caller stops waiting: cancelling the caller cannot stop a transcription
+        that is already running, so it must not free its worker either."""
+        future = self._executor.submit(self._transcribe_sync, audio, time.monotonic())
+        future.add_done_callback(lambda done: self._release(started, done.cancelled() or done.exception() is not None))
+        return asyncio.wrap_future(future)
+
+    def _transcribe_sync(self, audio, queued_at: float) -> str:
+        """Runs on a worker thread with a model checked out of the pool.
+        `audio` is 16 kHz float32 samples."""
+        with self._lock:
+            self._waits.append(time.monotonic() - queued_at)
+        model = self._models.get()
+        try:
+            return model.transcribe(audio)["text"]
+        finally:
+            self._models.put(model)
+
+    async def decode_upload(self, boundary: bytes, body, field: str, max_bytes: int = MAX_UPLOAD_BYTES):
+        """Decodes the `field` file of a multipart body while it streams in.
+
+        The format is checked from the filename as soon as the part's headers
+        arrive, and the body size with every chunk, so an oversized upload gets
+        a 413 without being read to the end."""
+        upload = _UploadField(boundary, field)
+        decoder = None
+        received = 0
+        size = 0
         try:
-            # Create a temporary file
-            with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(audio_file.filename)[1]) as tmp_file:
-                # Save uploaded file to temp location
-                contents = await audio_file.read()
-                tmp_file.write(contents)
-                tmp_path = tmp_file.name
+            async for chunk in body:
+                received += len(chunk)
+                if received > max_bytes:
+                    raise HTTPException(status_code=413, detail=f"File too large (max {max_bytes // (1024 * 1024)}MB)")
+                try:
+                    upload.write(chunk)
+                except ValueError:
+                    raise HTTPException(status_code=400, detail="Malformed multipart upload")
+
+                if decoder is None and upload.filename is not None:
+                    # Check file extension
+                    suffix = os.path.splitext(upload.filename)[1].lower()
+                    if suffix not in VALID_EXTENSIONS:
+                        raise HTTPException(status_code=400, detail="Invalid file format. Supported formats: MP3, WAV, M4A, OGG, FLAC, WEBM.")
+                    decoder = AudioStreamDecoder(suffix)
+                    await decoder.start()
+                for data in upload.take():
+                    size += len(data)
+                    await decoder.write(data)
+            upload.finalize()
 
-            # Check file extension
-            valid_extensions = (".mp3", ".wav", ".m4a", ".ogg", ".flac", ".webm")
-            if not tmp_path.lower().endswith(valid_extensions):
-                raise HTTPException(status_code=400, detail="Invalid file format. Supported formats: MP3, WAV, M4A, OGG, FLAC, WEBM.")
+            if decoder is None:
+                raise HTTPException(status_code=400, detail=f"No {field} file in the upload")
+            if not size:
+                raise HTTPException(status_code=400, detail="Empty audio file")
+            return await decoder.finish()
+        finally:
+            if decoder is not None:
+                await decoder.close()
 
-            # Transcribe the audio file
-            result = self.model.transcribe(tmp_path)
+    async def transcribe_upload(self, content_type: str, body, field: str = "audio_file") -> str:
+        """Convert speech in an uploaded audio file to text.
 
-            # Clean up temporary file
-            try:
-                os.unlink(tmp_path)
-            except:
-                pass
+        `body` is the raw multipart/form-data request body as an async iterator
+        of chunks (Request.stream()). It is parsed as it arrives, and the file
+        bytes go straight into ffmpeg instead of being spooled first (see
+        decode_upload). Transcription runs on the worker pool, so the event
+        loop stays free. Raises a 503 when all workers are busy and the queue
+        is full."""
+        kind, options = parse_options_header(content_type)
+        if kind != b"multipart/form-data" or not options.get(b"boundary"):
+            raise HTTPException(status_code=400, detail="Expected a multipart/form-data upload")
+
+        self._admit()
+        started = time.monotonic()
+        transcription = None
+        try:
+            audio = await self.decode_upload(options[b"boundary"], body, field)
 
-            return result["text"]
+            # Transcribe the audio
+            transcription = self._submit(audio, started)
+            return await transcription
 
+        except HTTPException:
+            raise
         except Exception as e:
-            # Clean up temporary file if it exists
-            if 'tmp_path' in locals() and os.path.exists(tmp_path):
-                try:
-                    os.unlink(tmp_path)
-                except:
-                    pass
             raise HTTPException(status_code=500, detail=f"Transcription error: {str(e)}")
+        finally:
+            if transcription is None:
+                self._release(started, True)
+
+    def has_idle_worker(self) -> bool:
+        with self._lock:
+            return self._in_flight < self.workers
+
+    async def transcribe_array(self, audio) -> str:
+        """Transcribes 16 kHz mono float32 samples on the worker pool.
+        Raises a 503 when all workers are busy and the queue is full."""
+        self._admit()
+        return await self._submit(audio, time.monotonic())
+
+    def metrics(self) -> dict:
+        """Request counts, current load and latency (upload to text, and time spent waiting for a model)"""
+        with self._lock:
+            latencies = list(self._latencies)
+            waits = list(self._waits)
+            metrics = dict(self._counts)
+            metrics["in_flight"] = self._in_flight
+            metrics["queued"] = max(self._in_flight - self.workers, 0)
+        metrics["workers"] = self.workers
+        metrics["max_queue"] = self.max_queue
+        metrics.update(latency_summary(latencies))
+        metrics.update(latency_summary(waits, "queue_wait"))
+        return metrics
 
 # Initialize the speech-to-text processor with the tiny model
-speech_processor = SpeechToText(model_size="tiny")
\ No newline at end of file
+speech_processor = SpeechToText(model_size="tiny") if STT_WORKERS > 0 else None
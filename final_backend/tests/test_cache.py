@@ -0,0 +1,48 @@
+import time
+
+from services.cache import PersistentCache
+
+
+def rows(cache):
+    return cache._conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+
+def test_values_round_trip_and_count_hits(tmp_path):
+    cache = PersistentCache(str(tmp_path / "cache.db"))
+    cache.set("a", {"tag": "<Mira><joy>"})
+    cache.set("a", {"tag": "<Mira><fear>"})
+    assert cache.get("a") == {"tag": "<Mira><fear>"}
+    assert cache.get("b") is None
+    assert cache.stats() == {"hits": 1, "misses": 1, "hit_rate": 0.5}
+    assert cache._count == rows(cache) == 1
+
+
+def test_expired_entries_miss_and_are_evicted(tmp_path, monkeypatch):
+    cache = PersistentCache(str(tmp_path / "cache.db"), ttl_seconds=60, evict_every=3)
+    cache.set("old", 1)
+    monkeypatch.setattr(time, "time", lambda now=time.time(): now + 120)
+    assert cache.get("old") is None
+    cache.set("new", 2)
+    cache.set("newer", 3)  # third insert runs the eviction
+    assert cache._count == rows(cache) == 2
+    assert cache.get("new") == 2
+
+
+def test_least_recently_used_are_dropped(tmp_path):
+    cache = PersistentCache(str(tmp_path / "cache.db"), max_entries=3, evict_every=2)
+    for key in "abc":
+        cache.set(key, key)
+        time.sleep(0.01)
+    assert cache.get("a") == "a"  # now more recent than b and c
+    cache.set("d", "d")
+    assert cache._count == rows(cache) == 3
+    assert cache.get("b") is None
+    assert [cache.get(key) for key in "acd"] == ["a", "c", "d"]
+
+
+def test_count_survives_reopening(tmp_path):
+    path = str(tmp_path / "cache.db")
+    cache = PersistentCache(path)
+    for key in "abc":
+        cache.set(key, key)
+    assert PersistentCache(path)._count == 3
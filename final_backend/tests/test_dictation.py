@@ -0,0 +1,55 @@
+import asyncio
+import os
+import threading
+
+import numpy as np
+
+os.environ.setdefault("STT_WORKERS", "0")
+
+from services.dictation import DictationSession
+from services.speech_text import SpeechToText
+
+
+class ScriptedASR:
+    """Answers in call order; the first call waits for `release`."""
+
+    def __init__(self, release: threading.Event):
+        self.release = release
+        self.started = threading.Semaphore(0)
+        self.calls = 0
+
+    def transcribe(self, audio):
+        self.calls += 1
+        call = self.calls
+        self.started.release()
+        if call == 1:
+            self.release.wait(5)
+        return {"text": f"text {call}"}
+
+
+def test_partial_outlived_by_its_utterance_is_dropped():
+    release = threading.Event()
+    model = ScriptedASR(release)
+    processor = SpeechToText(workers=1, max_queue=1, asr_factory=lambda: model)
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    async def scenario():
+        session = DictationSession(processor, send)
+        audio = np.zeros(1600, dtype=np.float32)
+        session._partial_task = asyncio.ensure_future(session._partial(0, audio))
+        await asyncio.get_running_loop().run_in_executor(None, model.started.acquire)
+
+        final = asyncio.ensure_future(session._final(audio))
+        await asyncio.sleep(0.05)
+        # The final waits behind the partial, which still holds the worker
+        assert processor.metrics()["in_flight"] == 2
+        release.set()
+        await asyncio.gather(final, session._partial_task)
+
+    asyncio.run(scenario())
+    release.set()
+    assert sent == [{"type": "final", "utterance": 0, "text": "text 2"}]
+    assert processor.metrics()["in_flight"] == 0
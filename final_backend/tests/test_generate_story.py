@@ -0,0 +1,60 @@
+import os
+import types
+
+import pytest
+
+os.environ.setdefault("STORY_CACHE_PATH", "")
+
+import services.generate_story as generate_story
+
+
+@pytest.fixture
+def routes(monkeypatch):
+    """Stubs the model calls and records which generation path a request takes."""
+    taken = []
+    monkeypatch.setattr(generate_story, "_cached_stage", lambda stage, genre, context: "blueprint")
+
+    def outline_sections(api_key, enhanced_prompt, target_word_count):
+        count = -(-target_word_count // generate_story.OUTLINE_SECTION_WORDS)
+        return [{"summary": f"part {n}"} for n in range(count)]
+
+    def generate_sections(api_key, enhanced_prompt, sections, target_word_count):
+        taken.append(("outline", len(sections)))
+        yield from (section["summary"] for section in sections)
+
+    def generate_sequential(api_key, enhanced_prompt, target_word_count):
+        taken.append(("sequential", None))
+        yield "story"
+
+    monkeypatch.setattr(generate_story, "_outline_sections", outline_sections)
+    monkeypatch.setattr(generate_story, "_generate_sections", generate_sections)
+    monkeypatch.setattr(generate_story, "_generate_sequential", generate_sequential)
+    return taken
+
+
+@pytest.mark.parametrize("length, expected", [
+    ("short", ("sequential", None)),
+    ("medium", ("outline", 2)),
+    ("long", ("outline", 3)),
+])
+def test_outline_mode_sections_frontend_lengths(routes, length, expected):
+    list(generate_story.generate_story_chunks("fantasy", length, api_key="sk-test", mode="outline"))
+    assert routes == [expected]
+
+
+def test_sequential_mode_ignores_outline(routes):
+    list(generate_story.generate_story_chunks("fantasy", "long", api_key="sk-test", mode="sequential"))
+    assert routes == [("sequential", None)]
+
+
+def test_sections_are_asked_for_their_share_of_the_target(monkeypatch):
+    prompts = []
+
+    def chat(messages, **kwargs):
+        prompts.append(messages[-1]["content"])
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=types.SimpleNamespace(content="text"))])
+
+    monkeypatch.setattr(generate_story.llm, "chat", chat)
+    sections = [{"summary": f"part {n}"} for n in range(3)]
+    generate_story._write_section("sk-test", "blueprint", sections, 1, 1000)
+    assert "about 333 words" in prompts[0]
@@ -0,0 +1,228 @@
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+# Keep the import from creating the on-disk tag cache
+os.environ.setdefault("TAG_CACHE_PATH", "")
+
+import services.line_tagging as line_tagging
+from services.line_tagging import LOCAL_TAG_THRESHOLD, StoryMatcher, _local_tag, _merge_character_names
+
+CAST = ["John", "Sadie", "Joy", "Al"]
+
+
+@pytest.fixture(scope="module")
+def matcher():
+    return StoryMatcher(CAST)
+
+
+@pytest.mark.parametrize("line", [
+    "She gathered her courage and stepped in.",
+    "John walked to the storage room.",
+    "They enjoyed dinner.",
+    "The intense silence stretched.",
+    "The promise went unsaid.",
+])
+def test_keywords_do_not_match_inside_words(matcher, line):
+    assert _local_tag(line, matcher) == ("Narrator", "neutral", 0.9)
+
+
+def test_name_is_not_read_as_a_keyword(matcher):
+    # "sad" inside "Sadie" must not compete with "smiled"
+    assert _local_tag("Sadie smiled at the window.", matcher)[1] == "joy"
+
+
+@pytest.mark.parametrize("line, speaker", [
+    ('"Hi," said Sadie.', "Sadie"),
+    ('"Stop!" John shouted.', "John"),
+    ('"Don\'t," said Al.', "Al"),
+])
+def test_adjacent_attribution_is_trusted(matcher, line, speaker):
+    character, _, confidence = _local_tag(line, matcher)
+    assert character == speaker
+    assert confidence >= LOCAL_TAG_THRESHOLD
+
+
+@pytest.mark.parametrize("line", [
+    "'Run!' shouted John.",
+    "‘Run!’ shouted John.",
+    '"Stop!" she shouted at John.',
+    '"Hi," said Sadie. "Bye," said John.',
+    "Run, John shouted.",
+    '"Hi," she said, smiling at John.',
+])
+def test_ambiguous_speech_is_escalated(matcher, line):
+    _, _, confidence = _local_tag(line, matcher)
+    assert confidence < LOCAL_TAG_THRESHOLD
+
+
+def test_apostrophes_stay_narration(matcher):
+    assert _local_tag("John's dog didn't bark.", matcher) == ("Narrator", "neutral", 0.9)
+
+
+def test_name_that_is_also_a_keyword(matcher):
+    character, emotion, confidence = _local_tag('"We made it," said Joy.', matcher)
+    assert (character, emotion) == ("Joy", "neutral")
+    assert confidence >= LOCAL_TAG_THRESHOLD
+
+
+class ShutDownExecutor(ThreadPoolExecutor):
+    def submit(self, *args, **kwargs):
+        raise RuntimeError("cannot schedule new futures after shutdown")
+
+
+def test_failed_tagging_stops_story_generation(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(line_tagging, "_scan_characters", lambda *args, **kwargs: [])
+    monkeypatch.setattr(line_tagging, "ThreadPoolExecutor", ShutDownExecutor)
+    generated = []
+    closed = threading.Event()
+
+    def story_chunks():
+        try:
+            for n in range(20):
+                time.sleep(0.02)  # one model call per section
+                generated.append(n)
+                yield "\n".join(f"Line {n}.{i}." for i in range(5))
+        finally:
+            closed.set()
+
+    story, tagged = line_tagging.analyze_and_tag_story_stream(story_chunks(), api_key="sk-test", batch_size=1)
+    assert tagged is None
+    assert closed.is_set()
+    assert len(generated) < 5
+    assert "Line 0.0." in story
+
+
+def test_concurrent_stories_use_their_own_keys(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(line_tagging, "tag_cache", None)
+    seen = []
+    both_started = threading.Barrier(2)
+
+    def chat_text(messages, model="gpt-4", api_key=None, **kwargs):
+        prompt = messages[-1]["content"]
+        seen.append((api_key, "Story A" in prompt, "Story B" in prompt))
+        if "comma-separated" in messages[0]["content"]:
+            both_started.wait(5)  # both stories are in flight before either tags
+            return "Mira"
+        return "[]"
+
+    monkeypatch.setattr(line_tagging.llm, "chat_text", chat_text)
+
+    def tag(story, key):
+        line_tagging.analyze_and_tag_story(story, api_key=key, batch_size=2, max_concurrency=2)
+
+    threads = [
+        threading.Thread(target=tag, args=("Story A begins.\n\"Wait,\" she said.", "sk-a")),
+        threading.Thread(target=tag, args=("Story B begins.\n\"Hurry,\" he said.", "sk-b")),
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(seen) > 2  # the quoted lines were escalated too
+    assert {key for key, *_ in seen} == {"sk-a", "sk-b"}
+    for key, story_a, story_b in seen:
+        assert (key == "sk-a") == story_a
+        assert (key == "sk-b") == story_b
+
+
+ESCALATED = ['"Run!" she cried.', '"Where were you?" he asked quietly.', '"Fine," someone muttered.']
+
+
+def scripted_completion(monkeypatch, replies):
+    """Replaces the model call with `replies` in order (an exception is
+    raised); returns the list of user prompts it was sent."""
+    monkeypatch.setattr(line_tagging, "tag_cache", None)
+    replies = iter(replies)
+    prompts = []
+
+    def chat_completion(model_name, api_key, messages, temperature, max_tokens):
+        prompts.append(messages[-1]["content"])
+        reply = next(replies)
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+    monkeypatch.setattr(line_tagging, "_chat_completion", chat_completion)
+    return prompts
+
+
+def tag_batch(matcher, lines=ESCALATED):
+    return line_tagging._tag_batch(1, lines, lines, matcher, "gpt-4", "sk-test")
+
+
+def test_batch_reasks_only_the_lines_still_missing(monkeypatch, matcher):
+    prompts = scripted_completion(monkeypatch, [
+        "Sorry, I cannot help with that.",
+        '[{"line": 1, "character": "Sadie", "emotion": "fear"}]',
+        '[{"line": 2, "character": "John", "emotion": "neutral"},'
+        ' {"line": 3, "character": "Narrator", "emotion": "anger"}]',
+    ])
+    assert tag_batch(matcher) == [
+        '<Sadie><fear>"' + ESCALATED[0] + '"',
+        '<John><neutral>"' + ESCALATED[1] + '"',
+        '<Narrator><anger>"' + ESCALATED[2] + '"',
+    ]
+    assert len(prompts) == 3
+    # The short answer left lines 2 and 3, and only they were asked again
+    assert "1. " + ESCALATED[0] not in prompts[2]
+    assert "2. " + ESCALATED[1] in prompts[2] and "3. " + ESCALATED[2] in prompts[2]
+
+
+def test_batch_reasks_unknown_characters(monkeypatch, matcher):
+    prompts = scripted_completion(monkeypatch, [
+        '[{"line": 1, "character": "Bob", "emotion": "fear"}]',
+        '[{"line": 1, "character": "sadie", "emotion": "Fear"}]',
+    ])
+    assert tag_batch(matcher, ESCALATED[:1]) == ['<Sadie><fear>"' + ESCALATED[0] + '"']
+    assert len(prompts) == 2
+
+
+def test_batch_falls_back_to_local_tags(monkeypatch, matcher):
+    prompts = scripted_completion(monkeypatch, [
+        '[{"line": 1, "character": "John", "emotion": "bored"}]',
+        "not json",
+        '[{"line": 1, "character": "Bob", "emotion": "joy"}]',
+    ])
+    assert tag_batch(matcher, ESCALATED[:1]) == ['<Narrator><sadness>"' + ESCALATED[0] + '"']
+    assert len(prompts) == 3
+
+
+def test_batch_does_not_reask_after_transport_errors(monkeypatch, matcher):
+    prompts = scripted_completion(monkeypatch, [ConnectionError("reset")])
+    tagged = tag_batch(matcher)
+    assert tagged[0] == '<Narrator><sadness>"' + ESCALATED[0] + '"'
+    assert len(prompts) == 1
+
+
+@pytest.mark.parametrize("names, characters, aliases", [
+    # Case differences: a capitalised spelling wins even when seen second
+    (["sadie", "Sadie"], ["Sadie"], {"sadie": "Sadie"}),
+    # A bare name joins its only titled form, which also answers to it
+    (["Dr. Watson", "watson"], ["Dr. Watson"], {"Watson": "Dr. Watson", "watson": "Dr. Watson"}),
+    (["Prof. Hale", "Professor Hale"], ["Prof. Hale"], {"Professor Hale": "Prof. Hale", "Hale": "Prof. Hale"}),
+    # Different titles are different people, and their shared surname is left alone
+    (["Mr. Smith", "Mrs. Smith", "Smith"], ["Mr. Smith", "Mrs. Smith", "Smith"], {}),
+    # A first name folds into the one full name containing it
+    (["John", "John Smith", "Sadie"], ["John Smith", "Sadie"], {"John": "John Smith"}),
+    (["John", "John Smith", "Dr. John Smith"], ["Dr. John Smith"],
+     {"John": "Dr. John Smith", "John Smith": "Dr. John Smith"}),
+    # ...but not when two full names share it
+    (["Al", "Al Jones", "Al Smith"], ["Al", "Al Jones", "Al Smith"], {}),
+    # List noise, possessives, bare titles and rambling replies are dropped
+    (["None", " *Mira* ", "Mira's", "n/a", "", "Dr.", "x" * 80], ["Mira"], {}),
+])
+def test_merge_character_names(names, characters, aliases):
+    assert _merge_character_names(names) == (characters, aliases)
+
+
+def test_merged_aliases_tag_as_their_character():
+    matcher = StoryMatcher(*_merge_character_names(["Dr. Watson", "John", "John Smith"]))
+    assert _local_tag('"Come quickly," said Watson.', matcher)[0] == "Dr. Watson"
+    assert _local_tag('"Me?" John asked.', matcher)[0] == "John Smith"
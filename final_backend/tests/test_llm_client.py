@@ -0,0 +1,65 @@
+import threading
+import time
+import types
+
+import services.llm_client as llm_client
+from services.llm_client import LLMClient
+
+
+class RateLimited(Exception):
+    status_code = 429
+
+
+class CountingLimiter:
+    def __init__(self):
+        self.acquired = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens: int = 0):
+        with self._lock:
+            self.acquired += 1
+
+
+def fake_client(replies):
+    """An OpenAI stand-in whose create() plays `replies` in order: an
+    exception is raised, a number is slept before answering."""
+    replies = iter(replies)
+    lock = threading.Lock()
+
+    def create(**kwargs):
+        with lock:
+            reply = next(replies)
+        if isinstance(reply, Exception):
+            raise reply
+        time.sleep(reply)
+        return types.SimpleNamespace(
+            choices=[types.SimpleNamespace(message=types.SimpleNamespace(content="ok"))],
+            usage=None
+        )
+
+    return types.SimpleNamespace(chat=types.SimpleNamespace(completions=types.SimpleNamespace(create=create)))
+
+
+def make_client(monkeypatch, replies, **kwargs):
+    monkeypatch.setattr(llm_client, "LLM_BACKOFF_BASE", 0.0)
+    client = LLMClient(mode="live", **kwargs)
+    monkeypatch.setattr(client, "_client", lambda api_key: fake_client(replies))
+    return client
+
+
+MESSAGES = [{"role": "user", "content": "hello"}]
+
+
+def test_every_retry_takes_from_the_limiter(monkeypatch):
+    limiter = CountingLimiter()
+    client = make_client(monkeypatch, [RateLimited(), RateLimited(), 0.0], max_retries=3)
+    assert client.chat_text(MESSAGES, rate_limiter=limiter) == "ok"
+    assert limiter.acquired == 3
+
+
+def test_hedged_duplicate_takes_from_the_limiter(monkeypatch):
+    limiter = CountingLimiter()
+    client = make_client(monkeypatch, [0.5, 0.0], max_retries=0, hedge_after=0.05)
+    assert client.chat_text(MESSAGES, rate_limiter=limiter) == "ok"
+    assert client.metrics()["hedges"] == 1
+    assert limiter.acquired == 2
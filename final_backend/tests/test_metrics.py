@@ -0,0 +1,10 @@
+from services.metrics import latency_summary
+
+
+def test_latency_summary():
+    durations = [0.001 * n for n in range(100, 0, -1)]
+    assert latency_summary(durations) == {"latency_avg_s": 0.051, "latency_p50_s": 0.051, "latency_p95_s": 0.096}
+    assert latency_summary([2.0], "queue_wait") == {
+        "queue_wait_avg_s": 2.0, "queue_wait_p50_s": 2.0, "queue_wait_p95_s": 2.0
+    }
+    assert latency_summary([]) == {}
@@ -0,0 +1,201 @@
+import asyncio
+import os
+import threading
+
+import numpy as np
+import pytest
+from fastapi import HTTPException
+
+# Keep the import from loading a Whisper model
+os.environ.setdefault("STT_WORKERS", "0")
+
+import services.speech_text as speech_text
+from services.speech_text import SpeechToText
+
+AUDIO = np.zeros(1600, dtype=np.float32)
+
+
+class BlockingASR:
+    """Holds every transcription until `release` is set."""
+
+    def __init__(self, release: threading.Event):
+        self.release = release
+        self.started = threading.Semaphore(0)
+
+    def transcribe(self, audio):
+        self.started.release()
+        self.release.wait(5)
+        return {"text": "hello"}
+
+
+@pytest.fixture
+def release():
+    event = threading.Event()
+    yield event
+    event.set()
+
+
+def make_processor(release, workers=1, max_queue=1):
+    return SpeechToText(workers=workers, max_queue=max_queue, asr_factory=lambda: BlockingASR(release))
+
+
+def test_full_pool_rejects_with_503(release):
+    processor = make_processor(release, workers=1, max_queue=1)
+
+    async def scenario():
+        running = asyncio.ensure_future(processor.transcribe_array(AUDIO))
+        waiting = asyncio.ensure_future(processor.transcribe_array(AUDIO))
+        await asyncio.sleep(0.05)
+        with pytest.raises(HTTPException) as rejected:
+            await processor.transcribe_array(AUDIO)
+        assert rejected.value.status_code == 503
+        assert rejected.value.headers == {"Retry-After": "5"}
+        busy = processor.metrics()
+        release.set()
+        return busy, await asyncio.gather(running, waiting)
+
+    busy, texts = asyncio.run(scenario())
+    assert texts == ["hello", "hello"]
+    assert busy["in_flight"] == 2
+    assert busy["queued"] == 1
+    assert busy["rejected"] == 1
+    assert busy["requests"] == 2
+
+
+def test_metrics_drain_after_the_queue_empties(release):
+    processor = make_processor(release, workers=2, max_queue=0)
+    release.set()
+
+    async def scenario():
+        return await asyncio.gather(*(processor.transcribe_array(AUDIO) for _ in range(2)))
+
+    assert asyncio.run(scenario()) == ["hello", "hello"]
+    metrics = processor.metrics()
+    assert metrics["in_flight"] == 0
+    assert metrics["queued"] == 0
+    assert metrics["requests"] == 2
+    assert metrics["failed"] == 0
+    assert "latency_p50_s" in metrics
+    assert processor.has_idle_worker()
+
+
+def test_cancelled_caller_keeps_its_worker_counted(release):
+    processor = make_processor(release, workers=1, max_queue=0)
+    model = processor._models.queue[0]
+
+    async def scenario():
+        partial = asyncio.ensure_future(processor.transcribe_array(AUDIO))
+        await asyncio.get_running_loop().run_in_executor(None, model.started.acquire)
+        partial.cancel()
+        await asyncio.sleep(0.05)
+        # The worker is still transcribing the cancelled request
+        assert not processor.has_idle_worker()
+        assert processor.metrics()["in_flight"] == 1
+        with pytest.raises(HTTPException) as rejected:
+            await processor.transcribe_array(AUDIO)
+        assert rejected.value.status_code == 503
+
+        release.set()
+        for _ in range(100):
+            if processor.has_idle_worker():
+                break
+            await asyncio.sleep(0.01)
+        return await processor.transcribe_array(AUDIO)
+
+    assert asyncio.run(scenario()) == "hello"
+    assert processor.metrics()["in_flight"] == 0
+
+
+class RecordingDecoder:
+    """Stands in for AudioStreamDecoder: records what reaches ffmpeg, and when."""
+    instances = []
+
+    def __init__(self, suffix):
+        self.suffix = suffix
+        self.writes = []
+        self.closed = False
+        RecordingDecoder.instances.append(self)
+
+    async def start(self):
+        pass
+
+    async def write(self, data):
+        self.writes.append(data)
+
+    async def finish(self):
+        return np.frombuffer(b"".join(self.writes), dtype=np.uint8).astype(np.float32)
+
+    async def close(self):
+        self.closed = True
+
+
+BOUNDARY = b"boundary42"
+
+
+def form_chunks(filename, chunks, field="audio_file"):
+    """A multipart body split so that each file chunk arrives on its own."""
+    yield b"--" + BOUNDARY + b'\r\nContent-Disposition: form-data; name="note"\r\n\r\nhi\r\n'
+    yield (b"--" + BOUNDARY + b'\r\nContent-Disposition: form-data; name="' + field.encode()
+           + b'"; filename="' + filename.encode() + b'"\r\n\r\n')
+    yield from chunks
+    yield b"\r\n--" + BOUNDARY + b"--\r\n"
+
+
+def stream(chunks, sent):
+    async def body():
+        for chunk in chunks:
+            sent.append(chunk)
+            yield chunk
+    return body()
+
+
+@pytest.fixture
+def decoder(monkeypatch):
+    RecordingDecoder.instances = []
+    monkeypatch.setattr(speech_text, "AudioStreamDecoder", RecordingDecoder)
+    return RecordingDecoder
+
+
+def test_upload_is_decoded_as_it_arrives(release, decoder):
+    processor = make_processor(release)
+    chunks = list(form_chunks("clip.wav", [b"a" * 1000, b"b" * 1000]))
+    sent = []
+    audio = asyncio.run(processor.decode_upload(BOUNDARY, stream(chunks, sent), "audio_file"))
+    assert len(audio) == 2000
+    (used,) = decoder.instances
+    assert used.suffix == ".wav"
+    assert b"".join(used.writes) == b"a" * 1000 + b"b" * 1000
+    assert len(used.writes) == 2  # one write per body chunk, nothing buffered
+    assert used.closed
+
+
+def test_oversized_upload_stops_reading(release, decoder):
+    processor = make_processor(release)
+    chunks = list(form_chunks("clip.wav", [b"x" * 1000] * 50))
+    sent = []
+    with pytest.raises(HTTPException) as too_large:
+        asyncio.run(processor.decode_upload(BOUNDARY, stream(chunks, sent), "audio_file", max_bytes=5000))
+    assert too_large.value.status_code == 413
+    assert len(sent) < 10
+    assert decoder.instances[0].closed
+
+
+@pytest.mark.parametrize("filename, chunks, detail", [
+    ("notes.txt", [b"x" * 10], "Invalid file format"),
+    ("clip.wav", [], "Empty audio file"),
+])
+def test_bad_uploads_are_rejected(release, decoder, filename, chunks, detail):
+    processor = make_processor(release)
+    with pytest.raises(HTTPException) as rejected:
+        asyncio.run(processor.decode_upload(BOUNDARY, stream(form_chunks(filename, chunks), []), "audio_file"))
+    assert rejected.value.status_code == 400
+    assert detail in rejected.value.detail
+    assert all(not used.writes for used in decoder.instances)
+
+
+def test_upload_must_be_multipart(release):
+    processor = make_processor(release)
+    with pytest.raises(HTTPException) as rejected:
+        asyncio.run(processor.transcribe_upload("audio/wav", stream([b"x"], [])))
+    assert rejected.value.status_code == 400
+    assert processor.metrics()["in_flight"] == 0
@@ -9,7 +9,7 @@ from pathlib import Path
 import logging
 import threading
 import asyncio
-import whisper
+import sys
 import glob
 import json
 import time
@@ -22,6 +22,10 @@ from difflib import SequenceMatcher
 import os.path
 from typing import Optional
 
+# Shared speech-recognition backends live in final_backend/services
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from services.asr import asr_from_env
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -297,6 +301,18 @@ def align_words(whisper_words: list[dict], correct_text: str) -> list[dict]:
     
     return aligned_words
 
+_timestamp_model = None
+_timestamp_model_lock = threading.Lock()
+_timestamp_transcribe_lock = threading.Lock()
+
+def get_timestamp_model():
+    """Loads the word-timestamp ASR model once and keeps it resident."""
+    global _timestamp_model
+    with _timestamp_model_lock:
+        if _timestamp_model is None:
+            _timestamp_model = asr_from_env("TIMESTAMPS", default_model="base")
+        return _timestamp_model
+
 def generate_word_timestamps(audio_path: str) -> Optional[str]:
     """Generate word-level timestamps by aligning audio with the input text."""
     try:
@@ -312,11 +328,12 @@ def generate_word_timestamps(audio_path: str) -> Optional[str]:
         original_text = load_text_file(INPUT_TEXT_FILE_PATH)
         dialogue_entries = parse_dialogue(original_text)
         
-        # Load Whisper model
-        model = whisper.load_model("base")
+        # Load Whisper model (TIMESTAMPS_ASR_BACKEND etc. select the backend)
+        model = get_timestamp_model()
         
-        # Transcribe audio with word-level timestamps
-        result = model.transcribe(audio_path, word_timestamps=True)
+        # Transcribe audio with word-level timestamps (one request at a time per model)
+        with _timestamp_transcribe_lock:
+            result = model.transcribe(audio_path, word_timestamps=True)
         
         # Initialize corrected segments
         corrected_segments = []
@@ -0,0 +1,177 @@
+"""Per-line latency of OpenVoice tone color conversion on CPU, for each load mode.
+
+    python benchmarks/openvoice_benchmark.py
+    python benchmarks/openvoice_benchmark.py --converter checkpoints_v2/converter --modes eager inference
+    python benchmarks/openvoice_benchmark.py --modes inference compile compile-bf16
+
+Each mode loads its own converter and converts the same lines one at a time,
+the way generate_speech calls it for a single line. It reports load time,
+mean latency per line, real-time factor (RTF, lower is faster) and the
+largest sample difference from the first mode's output, so a mode that
+changes the audio shows up next to its speed-up. Lines are cut from the
+bundled voice samples in default_voices.
+
+Without a checkpoint in --converter the model keeps its (seeded) random
+initial weights, which is enough for timing but not for listening; pass
+--config to point at a config.json in that case.
+
+Modes:
+    eager       the model as built for training, run under torch.no_grad
+    inference   inference=True, freeze=True: weight norm folded, torch.inference_mode
+    onnx        the inference model exported to ONNX and run with ONNX Runtime
+                (load time includes the export)
+    int8-dynamic    inference with quantize="dynamic" (int8 Linear/GRU)
+    int8-weights    inference with quantize="weights" (int8 conv weights)
+    compile     inference with enable_compile: torch.compile, dynamic shapes
+                (load time includes compiling and warm-up, minutes on CPU)
+    compile-bf16    compile under bfloat16 autocast (needs a bf16-capable CPU)
+
+The compile modes only run when named in --modes.
+
+Quality is reported as the SNR of each mode's output against the first
+mode's, in dB (higher is closer; inf means identical); as a rule of thumb
+above ~30 dB the difference is not audible. A mode whose SNR falls below
+--min-snr is flagged, and the script exits non-zero, so it can guard a
+quantization change.
+"""
+import argparse
+import glob
+import os
+import sys
+import tempfile
+import time
+
+import librosa
+import numpy as np
+import torch
+
+VOICE_BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(VOICE_BACKEND_DIR)
+from openvoice.api import ToneColorConverter
+
+DEFAULT_CONVERTER = os.path.join(VOICE_BACKEND_DIR, "checkpoints_v2", "converter")
+DEFAULT_CLIPS = os.path.join(VOICE_BACKEND_DIR, "default_voices", "*.wav")
+
+
+def load_converter(args, **kwargs):
+    # Same seed for every mode, so randomly initialised models share their weights
+    torch.manual_seed(0)
+    config = args.config or os.path.join(args.converter, "config.json")
+    converter = ToneColorConverter(config, device="cpu", enable_watermark=False, **kwargs)
+    checkpoint = os.path.join(args.converter, "checkpoint.pth")
+    if os.path.exists(checkpoint):
+        converter.load_ckpt(checkpoint)
+    elif converter.inference:
+        converter.optimize_for_inference(freeze=converter.freeze, quantize=converter.quantize)
+    return converter
+
+
+def load_onnx_converter(args):
+    converter = load_converter(args, inference=True, freeze=True)
+    # Always a fresh export, so the graph matches the weights being compared
+    onnx_path = os.path.join(tempfile.mkdtemp(prefix="openvoice_benchmark_"), "converter.onnx")
+    converter.use_onnx(onnx_path, threads=args.threads)
+    return converter
+
+
+def load_compiled_converter(args, bf16=False):
+    converter = load_converter(args, inference=True, freeze=True)
+    converter.enable_compile(bf16=bf16)
+    return converter
+
+
+MODES = {
+    "eager": lambda args: load_converter(args),
+    "inference": lambda args: load_converter(args, inference=True, freeze=True),
+    "onnx": load_onnx_converter,
+    "int8-dynamic": lambda args: load_converter(args, inference=True, freeze=True, quantize="dynamic"),
+    "int8-weights": lambda args: load_converter(args, inference=True, freeze=True, quantize="weights"),
+    "compile": load_compiled_converter,
+    "compile-bf16": lambda args: load_compiled_converter(args, bf16=True),
+}
+
+
+def snr_db(reference, output):
+    noise = sum(float(np.sum((r - o) ** 2)) for r, o in zip(reference, output))
+    signal = sum(float(np.sum(r ** 2)) for r in reference)
+    return float("inf") if noise == 0 else 10 * np.log10(signal / noise)
+
+
+def model_megabytes(model):
+    return sum(t.numel() * t.element_size() for t in model.state_dict().values() if torch.is_tensor(t)) / 1e6
+
+
+def load_lines(paths, sampling_rate, count, seconds):
+    """Cuts the clips into `count` lines of about `seconds` each, at the converter's rate."""
+    lines = []
+    length = int(seconds * sampling_rate)
+    for path in paths:
+        audio, _ = librosa.load(path, sr=sampling_rate)
+        lines += [audio[start:start + length] for start in range(0, len(audio) - length // 2, length)]
+    if not lines:
+        raise SystemExit("No audio found for the benchmark lines")
+    return [lines[i % len(lines)] for i in range(count)]
+
+
+def time_lines(converter, lines, src_se, tgt_se, repeats):
+    # Warm-up, so one-off allocation is not counted
+    converter.convert_batch([lines[0]], src_se, tgt_se, tau=0.0)
+    started = time.perf_counter()
+    for _ in range(repeats):
+        outputs = [converter.convert_batch([line], src_se, tgt_se, tau=0.0)[0] for line in lines]
+    return (time.perf_counter() - started) / (repeats * len(lines)), outputs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("clips", nargs="*", help="audio files to cut lines from (default: default_voices)")
+    parser.add_argument("--converter", default=DEFAULT_CONVERTER, help="directory with config.json and checkpoint.pth")
+    parser.add_argument("--config", help="config.json to use instead of the one in --converter")
+    parser.add_argument("--modes", nargs="+", choices=list(MODES),
+                        default=[mode for mode in MODES if not mode.startswith("compile")])
+    parser.add_argument("--lines", type=int, default=12)
+    parser.add_argument("--line-seconds", type=float, default=3.0)
+    parser.add_argument("--repeats", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--min-snr", type=float, default=30.0, help="lowest acceptable SNR in dB")
+    args = parser.parse_args()
+    torch.set_num_threads(args.threads)
+
+    paths = sorted(args.clips or glob.glob(DEFAULT_CLIPS))
+    rows, reference, src_se, tgt_se, lines = [], None, None, None, None
+    for mode in args.modes:
+        load_started = time.perf_counter()
+        converter = MODES[mode](args)
+        load_seconds = time.perf_counter() - load_started
+
+        if lines is None:
+            sampling_rate = converter.hps.data.sampling_rate
+            lines = load_lines(paths, sampling_rate, args.lines, args.line_seconds)
+            # Both SEs come from the first mode and are shared, so only conversion differs
+            src_se = converter.extract_se(lines[0])
+            tgt_se = converter.extract_se(lines[-1])
+            audio_seconds = sum(len(line) for line in lines) / len(lines) / sampling_rate
+
+        per_line, outputs = time_lines(converter, lines, src_se, tgt_se, args.repeats)
+        if reference is None:
+            reference = outputs
+        max_diff = max(float(np.abs(a - b).max()) for a, b in zip(outputs, reference))
+        rows.append((mode, load_seconds, model_megabytes(converter.model), per_line, per_line / audio_seconds,
+                     max_diff, snr_db(reference, outputs)))
+        del converter
+
+    print(f"\n{len(lines)} lines of {args.line_seconds:.1f}s, {args.threads} threads")
+    print(f"{'mode':<16}{'load s':>8}{'MB':>8}{'ms/line':>10}{'RTF':>8}{'speed-up':>10}{'max diff':>10}{'SNR dB':>8}")
+    failed = []
+    for mode, load_seconds, megabytes, per_line, rtf, max_diff, snr in rows:
+        flag = "" if snr >= args.min_snr else "  < min SNR"
+        if flag:
+            failed.append(mode)
+        print(f"{mode:<16}{load_seconds:>8.1f}{megabytes:>8.1f}{per_line * 1000:>10.1f}{rtf:>8.3f}"
+              f"{rows[0][3] / per_line:>9.2f}x{max_diff:>10.2e}{snr:>8.1f}{flag}")
+    if failed:
+        sys.exit(f"\nBelow {args.min_snr:.0f} dB SNR: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,7 +8,9 @@ import numpy as np
 import nltk
 import time
 import glob
+import librosa
 from openvoice.api import ToneColorConverter
+from openvoice.utils import concat_audio_segments
 from melo.api import TTS
 from scipy.io import wavfile
 
@@ -26,10 +28,25 @@ EMBEDDING_DIR = 'voice_embeddings'
 CKPT_CONVERTER = 'checkpoints_v2/converter'
 DEVICE = "cuda:0" if torch.cuda.is_available() else "cpu"
 SPEECH_SPEED = 0.93
+# "onnx" runs voice conversion with ONNX Runtime instead of PyTorch; the graph is
+# exported next to the checkpoint on first use. "compile" runs it through
+# torch.compile, compiled at startup (a few minutes) for lower per-line latency
+CONVERTER_BACKEND = os.getenv("OPENVOICE_BACKEND", "torch")
+# "bf16" runs the compiled backend under bfloat16 autocast, on CPUs with native
+# bf16 (AVX512-BF16 / AMX) or CUDA
+CONVERTER_PRECISION = os.getenv("OPENVOICE_PRECISION", "fp32")
+# Opt-in int8 for the PyTorch backend on CPU: "dynamic", "weights" or "all"
+# (see openvoice/quantization.py)
+CONVERTER_QUANTIZE = os.getenv("OPENVOICE_QUANTIZE") or None
 
 # Initialize tone color converter once
-tone_color_converter = ToneColorConverter(f'{CKPT_CONVERTER}/config.json', device=DEVICE)
+tone_color_converter = ToneColorConverter(f'{CKPT_CONVERTER}/config.json', device=DEVICE, inference=True,
+                                          quantize=CONVERTER_QUANTIZE)
 tone_color_converter.load_ckpt(f'{CKPT_CONVERTER}/checkpoint.pth')
+if CONVERTER_BACKEND == "onnx":
+    tone_color_converter.use_onnx(f'{CKPT_CONVERTER}/converter.onnx')
+elif CONVERTER_BACKEND == "compile":
+    tone_color_converter.enable_compile(bf16=CONVERTER_PRECISION == "bf16")
 
 def clean_voice_embeddings():
     """Remove all .pth files from the voice embeddings directory."""
@@ -159,7 +176,13 @@ def generate_audio(dialogue, character_voices, output_dir='outputs_v2'):
     base_speaker = list(speaker_ids.keys())[0].lower().replace('_', '-')
     source_se = torch.load(f'checkpoints_v2/base_speakers/ses/{base_speaker}.pth', map_location=DEVICE)
     
-    audio_segments = []
+    base_speaker_key = list(speaker_ids.keys())[0]
+    tts_rate = model.hps.data.sampling_rate
+    sample_rate = tone_color_converter.hps.data.sampling_rate
+    
+    # Synthesize every line with the base speaker, grouped by character so each
+    # character's lines can be voice converted together
+    lines_by_character = {}
     total_lines = len(dialogue)
     
     for idx, entry in enumerate(dialogue):
@@ -172,38 +195,41 @@ def generate_audio(dialogue, character_voices, output_dir='outputs_v2'):
             logger.warning(f"No voice embedding found for {character}, skipping")
             continue
         
-        target_se = torch.load(processed_voices[character], map_location=DEVICE)
-        tmp_path = f'{output_dir}/tmp_{character}.wav'
-        output_path = f'{output_dir}/output_{character}_{len(audio_segments)}.wav'
-        
         try:
-            # Generate base audio
-            base_speaker_key = list(speaker_ids.keys())[0]
-            model.tts_to_file(text, speaker_ids[base_speaker_key], tmp_path, speed=SPEECH_SPEED)
-            
-            # Apply voice conversion
-            tone_color_converter.convert(
-                audio_src_path=tmp_path,
+            # Generate base audio, resampled to the converter's rate
+            base_audio = model.tts_to_file(text, speaker_ids[base_speaker_key], None, speed=SPEECH_SPEED)
+            base_audio = librosa.resample(base_audio, orig_sr=tts_rate, target_sr=sample_rate)
+            lines_by_character.setdefault(character, []).append((idx, base_audio))
+        except Exception as e:
+            logger.error(f"Failed to synthesize line for {character}: {e}")
+    
+    # Apply voice conversion, a few batched passes per character
+    converted = {}
+    for character, lines in lines_by_character.items():
+        try:
+            target_se = torch.load(processed_voices[character], map_location=DEVICE)
+            outputs = tone_color_converter.convert_batch(
+                [audio for _, audio in lines],
                 src_se=source_se,
                 tgt_se=target_se,
-                output_path=output_path,
                 message="@MyShell"
             )
-            
-            # Add to segments
-            sample_rate, audio_data = wavfile.read(output_path)
-            audio_segments.append(audio_data)
-            logger.info(f"Added audio segment: {len(audio_data)} samples")
-            
+            for (idx, _), audio in zip(lines, outputs):
+                converted[idx] = audio
+            logger.info(f"Converted {len(lines)} lines for {character}")
         except Exception as e:
             logger.error(f"Failed to process audio for {character}: {e}")
     
+    # Reassemble in dialogue order
+    audio_segments = [converted[idx] for idx in sorted(converted)]
+    
     if not audio_segments:
         logger.error("No audio segments generated.")
         return
     
     # Merge all segments
-    final_audio = np.concatenate(audio_segments)
+    final_audio = concat_audio_segments(audio_segments)
+    final_audio = (np.clip(final_audio, -1.0, 1.0) * 32767).astype(np.int16)
     final_path = f'{output_dir}/final_dialogue.wav'
     
     try:
@@ -1,10 +1,14 @@
 import requests
 import random
 import os
-from openai import OpenAI
+import sys
 from dotenv import load_dotenv
 import logging
 
+# Share the story backend's pooled LLM client (final_backend/services)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from services.llm_client import llm
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -71,8 +75,8 @@ def detect_emotions_from_text(file_path, openai_api_key):
         prompt = f"Analyze this text and return the single most dominant emotion (e.g., happy, sad, tense, calm) as a single word: {text[:1000]}"
         
         try:
-            client = OpenAI(api_key=openai_api_key)
-            response = client.chat.completions.create(
+            response = llm.chat(
+                api_key=openai_api_key,
                 model="gpt-3.5-turbo",  # Using gpt-3.5-turbo as fallback if gpt-4 isn't available
                 messages=[
                     {"role": "system", "content": "You are an AI assistant specializing in emotion analysis."},
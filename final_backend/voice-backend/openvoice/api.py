@@ -1,3 +1,5 @@
+import collections
+import contextlib
 import torch
 import numpy as np
 import re
@@ -7,14 +9,26 @@ from openvoice import commons
 import os
 import librosa
 from openvoice.text import text_to_sequence
-from openvoice.mel_processing import spectrogram_torch
+from openvoice.mel_processing import spectrogram_torch_batch
 from openvoice.models import SynthesizerTrn
 
 
 class OpenVoiceBaseClass(object):
+    # Submodules of SynthesizerTrn this wrapper never calls, dropped for inference
+    unused_modules = ()
+    # The SynthesizerTrn method this wrapper runs, exported by export_onnx and
+    # compiled by enable_compile
+    entry_point = None
+    # Once compiled, inputs are padded along time (phonemes for TTS, spectrogram
+    # frames for conversion) to a multiple of this, so lines share a few shapes
+    compile_pad_multiple = 1
+
     def __init__(self, 
                 config_path, 
-                device='cuda:0'):
+                device='cuda:0',
+                inference=False,
+                freeze=False,
+                quantize=None):
         if 'cuda' in device:
             assert torch.cuda.is_available()
 
@@ -29,17 +43,132 @@ class OpenVoiceBaseClass(object):
 
         model.eval()
         self.model = model
+        # What voice_conversion / infer are called on: the model itself, or an
+        # ONNX Runtime session after use_onnx
+        self.synthesizer = model
         self.hps = hps
         self.device = device
+        self.inference = inference
+        self.freeze = freeze
+        self.quantize = quantize
+        self.pad_multiple = 1
+        self.autocast_dtype = None
+        # Set by optimize_for_inference / enable_compile, after which the model's
+        # state-dict keys no longer match a checkpoint
+        self.optimized = False
+        self.compiled = False
+        # The quantize mode optimize_for_inference applied, if any
+        self.quantized = None
+        # Speaker conditioning precomputed per SE pair (ToneColorConverter),
+        # dropped whenever the weights or the way they run change
+        self.conditioning_cache = collections.OrderedDict()
 
     def load_ckpt(self, ckpt_path):
+        if self.optimized or self.compiled:
+            raise RuntimeError("load_ckpt needs a new {}: this one is already {}".format(
+                type(self).__name__, "compiled" if self.compiled else "optimized for inference"))
         checkpoint_dict = torch.load(ckpt_path, map_location=torch.device(self.device))
         a, b = self.model.load_state_dict(checkpoint_dict['model'], strict=False)
         print("Loaded checkpoint '{}'".format(ckpt_path))
         print('missing/unexpected keys:', a, b)
+        self.conditioning_cache.clear()
+        if self.inference:
+            self.optimize_for_inference(freeze=self.freeze, quantize=self.quantize)
+
+    def optimize_for_inference(self, freeze=False, quantize=None):
+        """Makes the model inference-only: weight norm is folded into the conv
+        weights, unused submodules are dropped and forward passes run under
+        torch.inference_mode. With `freeze` the parameters also stop requiring
+        grad, and `quantize` ("dynamic", "weights" or "all", see
+        openvoice/quantization.py) converts layers to int8 for CPU; quantized
+        models are for the PyTorch backend, not export_onnx. Needs the
+        checkpoint loaded first (load_ckpt does this when the model was created
+        with inference=True); loading another one afterwards takes a new
+        instance."""
+        self.model.remove_weight_norm()
+        for name in self.unused_modules:
+            if hasattr(self.model, name):
+                delattr(self.model, name)
+        if quantize:
+            from openvoice.quantization import quantize_model
+            quantize_model(self.model, quantize)
+            self.quantized = quantize
+        if freeze:
+            self.model.requires_grad_(False)
+        self.inference = True
+        self.optimized = True
+        self.conditioning_cache.clear()
+
+    def export_onnx(self, onnx_path, opset_version=17):
+        """Exports the loaded model's synthesis path (entry_point) to an ONNX file."""
+        from openvoice.onnx_backend import export_onnx
+        if self.quantized:
+            raise RuntimeError("export_onnx needs a float model, not one quantized with quantize={!r}".format(self.quantized))
+        if not self.inference:
+            self.optimize_for_inference(freeze=self.freeze)
+        os.makedirs(os.path.dirname(onnx_path) or '.', exist_ok=True)
+        export_onnx(self.model, self.entry_point, onnx_path, opset_version=opset_version)
+
+    def use_onnx(self, onnx_path, threads=None):
+        """Runs synthesis with ONNX Runtime from now on. The loaded model is
+        exported to `onnx_path` first unless that file exists, so delete it
+        after changing the checkpoint. extract_se keeps using PyTorch."""
+        from openvoice.onnx_backend import OnnxSynthesizer
+        if not os.path.exists(onnx_path):
+            self.export_onnx(onnx_path)
+        self.synthesizer = OnnxSynthesizer(onnx_path, device=self.device, threads=threads)
+
+    def enable_compile(self, bf16=False, warmup=True):
+        """Runs synthesis (entry_point) and the reference encoder through
+        torch.compile with dynamic shapes, padding inputs to a multiple of
+        compile_pad_multiple time steps so lines of similar length share a
+        graph. With `bf16` forward passes run under bfloat16 autocast, on CUDA
+        or on CPUs with native bf16 (AVX512-BF16 / AMX); elsewhere it is skipped
+        with a warning. Each new shape compiles on its first call, which takes
+        a while; `warmup` makes those calls now (see warmup). Call after
+        load_ckpt (which then refuses further checkpoints); it raises
+        RuntimeError after use_onnx or quantize="dynamic" / "all"."""
+        if self.synthesizer is not self.model:
+            raise RuntimeError("enable_compile is for the PyTorch backend, not use_onnx")
+        if self.quantized in ("dynamic", "all"):
+            raise RuntimeError("enable_compile cannot compile dynamically quantized layers "
+                               "(quantize={!r}); use quantize=\"weights\" or none".format(self.quantized))
+        setattr(self.model, self.entry_point, torch.compile(getattr(self.model, self.entry_point), dynamic=True))
+        if hasattr(self.model, 'ref_enc'):
+            self.model.ref_enc = torch.compile(self.model.ref_enc, dynamic=True)
+        self.pad_multiple = self.compile_pad_multiple
+        self.compiled = True
+        if bf16:
+            if 'cuda' in self.device or torch.ops.mkldnn._is_mkldnn_bf16_supported():
+                self.autocast_dtype = torch.bfloat16
+            else:
+                print('This CPU has no native bf16 support, running in float32')
+        self.conditioning_cache.clear()
+        if warmup:
+            self.warmup()
+
+    def warmup(self):
+        """Runs the model on dummy inputs, so compilation (see enable_compile)
+        happens before the first request."""
+
+    def _pad_time(self, x):
+        pad = -x.size(-1) % self.pad_multiple
+        return torch.nn.functional.pad(x, (0, pad)) if pad else x
+
+    @contextlib.contextmanager
+    def _inference_context(self, autocast=True):
+        with torch.inference_mode() if self.inference else torch.no_grad():
+            if autocast and self.autocast_dtype is not None:
+                with torch.autocast(torch.device(self.device).type, dtype=self.autocast_dtype):
+                    yield
+            else:
+                yield
 
 
 class BaseSpeakerTTS(OpenVoiceBaseClass):
+    unused_modules = ('enc_q',)
+    entry_point = 'infer'
+    compile_pad_multiple = 16
     language_marks = {
         "english": "EN",
         "chinese": "ZH",
@@ -55,12 +184,7 @@ class BaseSpeakerTTS(OpenVoiceBaseClass):
 
     @staticmethod
     def audio_numpy_concat(segment_data_list, sr, speed=1.):
-        audio_segments = []
-        for segment_data in segment_data_list:
-            audio_segments += segment_data.reshape(-1).tolist()
-            audio_segments += [0] * int((sr * 0.05)/speed)
-        audio_segments = np.array(audio_segments).astype(np.float32)
-        return audio_segments
+        return utils.concat_audio_segments(segment_data_list, gap=int((sr * 0.05)/speed))
 
     @staticmethod
     def split_sentences_into_pieces(text, language_str):
@@ -70,26 +194,34 @@ class BaseSpeakerTTS(OpenVoiceBaseClass):
         print(" > ===========================")
         return texts
 
-    def tts(self, text, output_path, speaker, language='English', speed=1.0):
+    def tts(self, text, output_path, speaker, language='English', speed=1.0, batch_size=8):
         mark = self.language_marks.get(language.lower(), None)
         assert mark is not None, f"language {language} is not supported"
 
         texts = self.split_sentences_into_pieces(text, mark)
 
-        audio_list = []
+        stn_tsts = []
         for t in texts:
             t = re.sub(r'([a-z])([A-Z])', r'\1 \2', t)
             t = f'[{mark}]{t}[{mark}]'
-            stn_tst = self.get_text(t, self.hps, False)
-            device = self.device
-            speaker_id = self.hps.speakers[speaker]
-            with torch.no_grad():
-                x_tst = stn_tst.unsqueeze(0).to(device)
-                x_tst_lengths = torch.LongTensor([stn_tst.size(0)]).to(device)
-                sid = torch.LongTensor([speaker_id]).to(device)
-                audio = self.model.infer(x_tst, x_tst_lengths, sid=sid, noise_scale=0.667, noise_scale_w=0.6,
-                                    length_scale=1.0 / speed)[0][0, 0].data.cpu().float().numpy()
-            audio_list.append(audio)
+            stn_tsts.append(self.get_text(t, self.hps, False))
+
+        device = self.device
+        speaker_id = self.hps.speakers[speaker]
+        hop = self.hps.data.hop_length
+        # Every batch is one infer call and each sentence is cut out by its y_mask
+        audio_list = [None] * len(stn_tsts)
+        with self._inference_context():
+            for index in utils.length_buckets([t.size(0) for t in stn_tsts], batch_size):
+                x_tst = torch.nn.utils.rnn.pad_sequence([stn_tsts[i] for i in index], batch_first=True).to(device)
+                x_tst = self._pad_time(x_tst)
+                x_tst_lengths = torch.LongTensor([stn_tsts[i].size(0) for i in index]).to(device)
+                sid = torch.LongTensor([speaker_id] * len(index)).to(device)
+                o, _, y_mask, _ = self.synthesizer.infer(x_tst, x_tst_lengths, sid=sid, noise_scale=0.667, noise_scale_w=0.6,
+                                    length_scale=1.0 / speed)
+                lengths = (y_mask.float().sum(dim=(1, 2)) * hop).long().tolist()
+                for row, i in enumerate(index):
+                    audio_list[i] = o[row, 0, :lengths[row]].data.cpu().float().numpy()
         audio = self.audio_numpy_concat(audio_list, sr=self.hps.data.sampling_rate, speed=speed)
 
         if output_path is None:
@@ -97,12 +229,26 @@ class BaseSpeakerTTS(OpenVoiceBaseClass):
         else:
             soundfile.write(output_path, audio, self.hps.data.sampling_rate)
 
+    def warmup(self, language='English'):
+        """Synthesizes one sentence and then two, compiling both the single
+        sentence and the batched shapes."""
+        speaker = list(self.hps.speakers.keys())[0]
+        for text in ("This sentence warms up the model.", "This sentence warms up the model. So does this one."):
+            self.tts(text, None, speaker, language=language)
+
 
 class ToneColorConverter(OpenVoiceBaseClass):
-    def __init__(self, *args, **kwargs):
+    entry_point = 'voice_conversion'
+    compile_pad_multiple = 32
+    # SE pairs whose speaker conditioning is kept; the least recently used goes first
+    conditioning_cache_size = 32
+    # Most 1 s chunks given to one wavmark encode
+    watermark_batch_size = 64
+
+    def __init__(self, *args, enable_watermark=True, **kwargs):
         super().__init__(*args, **kwargs)
 
-        if kwargs.get('enable_watermark', True):
+        if enable_watermark:
             import wavmark
             self.watermark_model = wavmark.load_model().to(self.device)
         else:
@@ -112,25 +258,27 @@ class ToneColorConverter(OpenVoiceBaseClass):
 
 
     def extract_se(self, ref_wav_list, se_save_path=None):
-        if isinstance(ref_wav_list, str):
+        """Speaker embedding averaged over reference segments.
+
+        `ref_wav_list` holds file paths and/or waveforms (numpy arrays or
+        tensors at hps.data.sampling_rate), or is a single one of those. All
+        segments go through the reference encoder as one padded batch."""
+        if isinstance(ref_wav_list, (str, np.ndarray, torch.Tensor)):
             ref_wav_list = [ref_wav_list]
         
         device = self.device
         hps = self.hps
-        gs = []
+        ys = []
         
-        for fname in ref_wav_list:
-            audio_ref, sr = librosa.load(fname, sr=hps.data.sampling_rate)
-            y = torch.FloatTensor(audio_ref)
-            y = y.to(device)
-            y = y.unsqueeze(0)
-            y = spectrogram_torch(y, hps.data.filter_length,
-                                        hps.data.sampling_rate, hps.data.hop_length, hps.data.win_length,
-                                        center=False).to(device)
-            with torch.no_grad():
-                g = self.model.ref_enc(y.transpose(1, 2)).unsqueeze(-1)
-                gs.append(g.detach())
-        gs = torch.stack(gs).mean(0)
+        for ref_wav in ref_wav_list:
+            if isinstance(ref_wav, str):
+                ref_wav, sr = librosa.load(ref_wav, sr=hps.data.sampling_rate)
+            ys.append(torch.as_tensor(ref_wav, dtype=torch.float32).reshape(-1).to(device))
+        with self._inference_context():
+            spec, spec_lengths = spectrogram_torch_batch(ys, hps.data.filter_length,
+                                        hps.data.sampling_rate, hps.data.hop_length, hps.data.win_length)
+            g = self.model.ref_enc(self._pad_time(spec).transpose(1, 2), lengths=spec_lengths)
+        gs = g.float().mean(0, keepdim=True).unsqueeze(-1).detach()
 
         if se_save_path is not None:
             os.makedirs(os.path.dirname(se_save_path), exist_ok=True)
@@ -142,61 +290,141 @@ class ToneColorConverter(OpenVoiceBaseClass):
         hps = self.hps
         # load audio
         audio, sample_rate = librosa.load(audio_src_path, sr=hps.data.sampling_rate)
-        audio = torch.tensor(audio).float()
-        
-        with torch.no_grad():
-            y = torch.FloatTensor(audio).to(self.device)
-            y = y.unsqueeze(0)
-            spec = spectrogram_torch(y, hps.data.filter_length,
-                                    hps.data.sampling_rate, hps.data.hop_length, hps.data.win_length,
-                                    center=False).to(self.device)
-            spec_lengths = torch.LongTensor([spec.size(-1)]).to(self.device)
-            audio = self.model.voice_conversion(spec, spec_lengths, sid_src=src_se, sid_tgt=tgt_se, tau=tau)[0][
-                        0, 0].data.cpu().float().numpy()
-            audio = self.add_watermark(audio, message)
-            if output_path is None:
-                return audio
-            else:
-                soundfile.write(output_path, audio, hps.data.sampling_rate)
-    
+        audio = self.convert_batch([audio], src_se, tgt_se, tau=tau, message=message)[0]
+        if output_path is None:
+            return audio
+        else:
+            soundfile.write(output_path, audio, hps.data.sampling_rate)
+
+    @staticmethod
+    def _stack_se(se, count, device):
+        """One SE for every item ([1, C, 1]), or a list/batch of one per item, as [count, C, 1]."""
+        if isinstance(se, (list, tuple)):
+            se = torch.cat([s.reshape(1, -1, 1) for s in se])
+        se = se.to(device)
+        return se.expand(count, -1, -1) if se.size(0) == 1 else se
+
+    def conditioning_for(self, src_se, tgt_se):
+        """Speaker conditioning for converting from one SE to another
+        (SynthesizerTrn.precompute_conditioning), computed on first use and
+        cached by the SEs' values, so every later line of the same character
+        skips those projections."""
+        key = tuple(se.detach().cpu().numpy().tobytes() for se in (src_se, tgt_se))
+        conditioning = self.conditioning_cache.get(key)
+        if conditioning is not None:
+            self.conditioning_cache.move_to_end(key)
+            return conditioning
+        with self._inference_context():
+            conditioning = self.model.precompute_conditioning(src_se.reshape(1, -1, 1).to(self.device),
+                                                              tgt_se.reshape(1, -1, 1).to(self.device))
+        self.conditioning_cache[key] = conditioning
+        if len(self.conditioning_cache) > self.conditioning_cache_size:
+            self.conditioning_cache.popitem(last=False)
+        return conditioning
+
+    def convert_batch(self, audios, src_se, tgt_se, tau=0.3, message="default", batch_size=8):
+        """Converts several waveforms at once.
+
+        `audios` is a list of 1-D numpy arrays or tensors at hps.data.sampling_rate.
+        `src_se` and `tgt_se` are either one SE used for every item or a list with
+        one SE per item. Items are sorted by length and run `batch_size` at a
+        time, each batch as a single voice_conversion pass over padded
+        spectrograms; every output is trimmed to its own length using y_mask.
+        With one SE each for source and target, their speaker conditioning
+        comes from conditioning_for. Returns a list of float32 numpy arrays in
+        the input order."""
+        hps = self.hps
+        hop = hps.data.hop_length
+        count = len(audios)
+        conditioning = None
+        if self.synthesizer is self.model and all(torch.is_tensor(se) and se.size(0) == 1 for se in (src_se, tgt_se)):
+            conditioning = self.conditioning_for(src_se, tgt_se)
+        src_se = self._stack_se(src_se, count, self.device)
+        tgt_se = self._stack_se(tgt_se, count, self.device)
+
+        # Similar lengths go together, so little of each batch is padding
+        order = sorted(range(count), key=lambda i: len(audios[i]))
+        results = [None] * count
+        with self._inference_context():
+            for start in range(0, count, batch_size):
+                index = order[start:start + batch_size]
+                ys = [torch.as_tensor(audios[i], dtype=torch.float32).reshape(-1).to(self.device) for i in index]
+                spec, spec_lengths = spectrogram_torch_batch(ys, hps.data.filter_length,
+                                            hps.data.sampling_rate, hop, hps.data.win_length)
+                spec = self._pad_time(spec)
+
+                o_hat, y_mask, _ = self.synthesizer.voice_conversion(
+                    spec, spec_lengths, sid_src=src_se[index], sid_tgt=tgt_se[index], tau=tau,
+                    conditioning=conditioning
+                )
+                lengths = (y_mask.float().sum(dim=(1, 2)) * hop).long().tolist()
+                for row, i in enumerate(index):
+                    results[i] = o_hat[row, 0, :lengths[row]].data.cpu().float().numpy()
+
+        return self.add_watermark_batch(results, message)
+
+    def warmup(self):
+        """Extracts an SE and converts a short and a longer clip, one at a
+        time and as a batch, compiling the shapes generate_speech uses."""
+        sr = self.hps.data.sampling_rate
+        rng = np.random.default_rng(0)
+        audios = [0.1 * rng.standard_normal(int(seconds * sr)).astype(np.float32) for seconds in (2, 6)]
+        se = self.extract_se(audios)
+        for batch in (audios[:1], audios):
+            self.convert_batch(batch, se, se)
+
     def add_watermark(self, audio, message):
+        return self.add_watermark_batch([audio], message)[0]
+
+    def add_watermark_batch(self, audios, message):
+        """Watermarks several clips with one wavmark encode.
+
+        Every 1 s chunk that would be marked (the first of each 2 s, one per 32
+        bits of the message) is collected across all clips, encoded
+        watermark_batch_size chunks per forward pass and written back in
+        place, so memory stays bounded however many clips there are."""
         if self.watermark_model is None:
-            return audio
+            return audios
         device = self.device
         bits = utils.string_to_bits(message).reshape(-1)
         n_repeat = len(bits) // 32
 
         K = 16000
         coeff = 2
-        for n in range(n_repeat):
-            trunck = audio[(coeff * n) * K: (coeff * n + 1) * K]
-            if len(trunck) != K:
+        chunks = []
+        for index, audio in enumerate(audios):
+            # Chunks are marked in order until one would run past the end
+            n_fit = min(n_repeat, (len(audio) // K + 1) // coeff)
+            if n_fit < n_repeat:
                 print('Audio too short, fail to add watermark')
-                break
-            message_npy = bits[n * 32: (n + 1) * 32]
-            
-            with torch.no_grad():
-                signal = torch.FloatTensor(trunck).to(device)[None]
-                message_tensor = torch.FloatTensor(message_npy).to(device)[None]
-                signal_wmd_tensor = self.watermark_model.encode(signal, message_tensor)
-                signal_wmd_npy = signal_wmd_tensor.detach().cpu().squeeze()
-            audio[(coeff * n) * K: (coeff * n + 1) * K] = signal_wmd_npy
-        return audio
+            chunks += [(index, n) for n in range(n_fit)]
+        if not chunks:
+            return audios
+
+        for start in range(0, len(chunks), self.watermark_batch_size):
+            batch = chunks[start:start + self.watermark_batch_size]
+            with self._inference_context(autocast=False):
+                signal = torch.FloatTensor(np.stack([
+                    audios[index][(coeff * n) * K: (coeff * n + 1) * K] for index, n in batch
+                ])).to(device)
+                message_tensor = torch.FloatTensor(np.stack([bits[n * 32: (n + 1) * 32] for _, n in batch])).to(device)
+                signal_wmd_npy = self.watermark_model.encode(signal, message_tensor).detach().cpu().numpy()
+            for (index, n), signal_wmd in zip(batch, signal_wmd_npy):
+                audios[index][(coeff * n) * K: (coeff * n + 1) * K] = signal_wmd
+        return audios
 
     def detect_watermark(self, audio, n_repeat):
-        bits = []
         K = 16000
         coeff = 2
-        for n in range(n_repeat):
-            trunck = audio[(coeff * n) * K: (coeff * n + 1) * K]
-            if len(trunck) != K:
-                print('Audio too short, fail to detect watermark')
-                return 'Fail'
-            with torch.no_grad():
-                signal = torch.FloatTensor(trunck).to(self.device).unsqueeze(0)
-                message_decoded_npy = (self.watermark_model.decode(signal) >= 0.5).int().detach().cpu().numpy().squeeze()
-            bits.append(message_decoded_npy)
-        bits = np.stack(bits).reshape(-1, 8)
+        if len(audio) < (coeff * (n_repeat - 1) + 1) * K:
+            print('Audio too short, fail to detect watermark')
+            return 'Fail'
+        with self._inference_context(autocast=False):
+            signal = torch.FloatTensor(np.stack([
+                audio[(coeff * n) * K: (coeff * n + 1) * K] for n in range(n_repeat)
+            ])).to(self.device)
+            bits = (self.watermark_model.decode(signal) >= 0.5).int().detach().cpu().numpy()
+        bits = bits.reshape(-1, 8)
         message = utils.bits_to_string(bits)
         return message
     
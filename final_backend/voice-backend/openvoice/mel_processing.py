@@ -75,6 +75,49 @@ def spectrogram_torch(y, n_fft, sampling_rate, hop_size, win_size, center=False)
     return spec
 
 
+def spectrogram_torch_batch(ys, n_fft, sampling_rate, hop_size, win_size):
+    """Spectrograms of several 1-D waveforms of different lengths from one STFT.
+
+    Each waveform gets the same reflect padding as in spectrogram_torch before
+    they are zero-padded to a common length, so every item's frames equal its
+    own spectrogram_torch(center=False). Frames past an item's end are zero.
+    Returns (spec [B, n_fft // 2 + 1, T], frame lengths [B])."""
+    pad = int((n_fft - hop_size) / 2)
+    ys = [
+        torch.nn.functional.pad(y.reshape(1, 1, -1), (pad, pad), mode="reflect").reshape(-1)
+        for y in ys
+    ]
+    lengths = torch.LongTensor([(y.size(0) - n_fft) // hop_size + 1 for y in ys]).to(ys[0].device)
+    y = torch.nn.utils.rnn.pad_sequence(ys, batch_first=True)
+
+    global hann_window
+    dtype_device = str(y.dtype) + "_" + str(y.device)
+    wnsize_dtype_device = str(win_size) + "_" + dtype_device
+    if wnsize_dtype_device not in hann_window:
+        hann_window[wnsize_dtype_device] = torch.hann_window(win_size).to(
+            dtype=y.dtype, device=y.device
+        )
+
+    spec = torch.stft(
+        y,
+        n_fft,
+        hop_length=hop_size,
+        win_length=win_size,
+        window=hann_window[wnsize_dtype_device],
+        center=False,
+        pad_mode="reflect",
+        normalized=False,
+        onesided=True,
+        return_complex=False,
+    )
+
+    spec = torch.sqrt(spec.pow(2).sum(-1) + 1e-6)
+    spec = spec[:, :, :int(lengths.max())]
+    frames = torch.arange(spec.size(-1), device=spec.device)
+    spec = spec * (frames[None, :] < lengths[:, None]).unsqueeze(1).to(spec.dtype)
+    return spec, lengths
+
+
 def spectrogram_torch_conv(y, n_fft, sampling_rate, hop_size, win_size, center=False):
     # if torch.min(y) < -1.:
     #     print('min value is ', torch.min(y))
@@ -209,12 +209,12 @@ class PosteriorEncoder(nn.Module):
         )
         self.proj = nn.Conv1d(hidden_channels, out_channels * 2, 1)
 
-    def forward(self, x, x_lengths, g=None, tau=1.0):
+    def forward(self, x, x_lengths, g=None, tau=1.0, g_cond=None):
         x_mask = torch.unsqueeze(commons.sequence_mask(x_lengths, x.size(2)), 1).to(
             x.dtype
         )
         x = self.pre(x) * x_mask
-        x = self.enc(x, x_mask, g=g)
+        x = self.enc(x, x_mask, g=g, g_cond=g_cond)
         stats = self.proj(x) * x_mask
         m, logs = torch.split(stats, self.out_channels, dim=1)
         z = (m + torch.randn_like(m) * tau * torch.exp(logs)) * x_mask
@@ -266,23 +266,37 @@ class Generator(torch.nn.Module):
         self.conv_post = Conv1d(ch, 1, 7, 1, padding=3, bias=False)
         self.ups.apply(init_weights)
 
+        self.upsample_rates = upsample_rates
         if gin_channels != 0:
             self.cond = nn.Conv1d(gin_channels, upsample_initial_channel, 1)
 
-    def forward(self, x, g=None):
+    def condition(self, g):
+        return self.cond(g)
+
+    def forward(self, x, g=None, g_cond=None, x_mask=None):
+        # With x_mask, padded frames are zeroed after every stage and inside
+        # the resblocks, so the conv_pre bias and the conditioning added there
+        # never reach the end of a shorter item in a padded batch
         x = self.conv_pre(x)
-        if g is not None:
+        if g_cond is not None:
+            x = x + g_cond
+        elif g is not None:
             x = x + self.cond(g)
+        if x_mask is not None:
+            x = x * x_mask
 
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, modules.LRELU_SLOPE)
             x = self.ups[i](x)
+            if x_mask is not None:
+                x_mask = torch.repeat_interleave(x_mask, self.upsample_rates[i], dim=2)
+                x = x * x_mask
             xs = None
             for j in range(self.num_kernels):
                 if xs is None:
-                    xs = self.resblocks[i * self.num_kernels + j](x)
+                    xs = self.resblocks[i * self.num_kernels + j](x, x_mask)
                 else:
-                    xs += self.resblocks[i * self.num_kernels + j](x)
+                    xs += self.resblocks[i * self.num_kernels + j](x, x_mask)
             x = xs / self.num_kernels
         x = F.leaky_relu(x)
         x = self.conv_post(x)
@@ -336,7 +350,10 @@ class ReferenceEncoder(nn.Module):
         else:
             self.layernorm = None
 
-    def forward(self, inputs, mask=None):
+    def forward(self, inputs, mask=None, lengths=None):
+        """`lengths` ([N] frame counts) makes a zero-padded batch give each item
+        the same embedding it gets on its own: padded frames are zeroed before
+        every conv and skipped by the GRU."""
         N = inputs.size(0)
 
         out = inputs.view(N, 1, -1, self.spec_channels)  # [N, 1, Ty, n_freqs]
@@ -344,6 +361,9 @@ class ReferenceEncoder(nn.Module):
             out = self.layernorm(out)
 
         for conv in self.convs:
+            if lengths is not None:
+                out = out * commons.sequence_mask(lengths, out.size(2))[:, None, :, None].to(out.dtype)
+                lengths = (lengths - 1) // 2 + 1  # kernel 3, stride 2, padding 1
             out = conv(out)
             # out = wn(out)
             out = F.relu(out)  # [N, 128, Ty//2^K, n_mels//2^K]
@@ -353,7 +373,11 @@ class ReferenceEncoder(nn.Module):
         N = out.size(0)
         out = out.contiguous().view(N, T, -1)  # [N, Ty//2^K, 128*n_mels//2^K]
 
-        self.gru.flatten_parameters()
+        if lengths is not None:
+            out = nn.utils.rnn.pack_padded_sequence(out, lengths.cpu(), batch_first=True, enforce_sorted=False)
+
+        if hasattr(self.gru, 'flatten_parameters'):  # not on a dynamically quantized GRU
+            self.gru.flatten_parameters()
         memory, out = self.gru(out)  # out --- [1, N, 128]
 
         return self.proj(out.squeeze(0))
@@ -387,13 +411,19 @@ class ResidualCouplingBlock(nn.Module):
             self.flows.append(modules.ResidualCouplingLayer(channels, hidden_channels, kernel_size, dilation_rate, n_layers, gin_channels=gin_channels, mean_only=True))
             self.flows.append(modules.Flip())
 
-    def forward(self, x, x_mask, g=None, reverse=False):
+    def condition(self, g):
+        """Speaker projections of every coupling layer (None for the flips),
+        for forward(g_conds=...)."""
+        return [flow.enc.condition(g) if hasattr(flow, 'enc') else None for flow in self.flows]
+
+    def forward(self, x, x_mask, g=None, reverse=False, g_conds=None):
+        g_conds = g_conds or [None] * len(self.flows)
         if not reverse:
-            for flow in self.flows:
-                x, _ = flow(x, x_mask, g=g, reverse=reverse)
+            for flow, g_cond in zip(self.flows, g_conds):
+                x, _ = flow(x, x_mask, g=g, reverse=reverse, g_cond=g_cond)
         else:
-            for flow in reversed(self.flows):
-                x = flow(x, x_mask, g=g, reverse=reverse)
+            for flow, g_cond in zip(reversed(self.flows), reversed(g_conds)):
+                x = flow(x, x_mask, g=g, reverse=reverse, g_cond=g_cond)
         return x
 
 class SynthesizerTrn(nn.Module):
@@ -464,6 +494,18 @@ class SynthesizerTrn(nn.Module):
             self.emb_g = nn.Embedding(n_speakers, gin_channels)
         self.zero_g = zero_g
 
+    def remove_weight_norm(self):
+        """Folds weight norm into the plain conv weights, for inference."""
+        self.dec.remove_weight_norm()
+        if hasattr(self, 'enc_q'):
+            self.enc_q.enc.remove_weight_norm()
+        for flow in self.flow.flows:
+            if hasattr(flow, 'enc'):
+                flow.enc.remove_weight_norm()
+        if hasattr(self, 'ref_enc'):
+            for conv in self.ref_enc.convs:
+                remove_weight_norm(conv)
+
     def infer(self, x, x_lengths, sid=None, noise_scale=1, length_scale=1, noise_scale_w=1., sdp_ratio=0.2, max_len=None):
         x, m_p, logs_p, x_mask = self.enc_p(x, x_lengths)
         if self.n_speakers > 0:
@@ -486,14 +528,29 @@ class SynthesizerTrn(nn.Module):
 
         z_p = m_p + torch.randn_like(m_p) * torch.exp(logs_p) * noise_scale
         z = self.flow(z_p, y_mask, g=g, reverse=True)
-        o = self.dec((z * y_mask)[:,:,:max_len], g=g)
+        o = self.dec((z * y_mask)[:,:,:max_len], g=g, x_mask=y_mask[:,:,:max_len])
         return o, attn, y_mask, (z, z_p, m_p, logs_p)
 
-    def voice_conversion(self, y, y_lengths, sid_src, sid_tgt, tau=1.0):
+    def precompute_conditioning(self, sid_src, sid_tgt):
+        """The speaker projections voice_conversion computes from sid_src and
+        sid_tgt on every call, to pass back as `conditioning` when converting
+        many clips between the same pair. A batch of one broadcasts over any
+        batch size."""
+        return {
+            'enc_q': self.enc_q.enc.condition(sid_src if not self.zero_g else torch.zeros_like(sid_src)),
+            'flow_src': self.flow.condition(sid_src),
+            'flow_tgt': self.flow.condition(sid_tgt),
+            'dec': self.dec.condition(sid_tgt if not self.zero_g else torch.zeros_like(sid_tgt)),
+        }
+
+    def voice_conversion(self, y, y_lengths, sid_src, sid_tgt, tau=1.0, conditioning=None):
         g_src = sid_src
         g_tgt = sid_tgt
-        z, m_q, logs_q, y_mask = self.enc_q(y, y_lengths, g=g_src if not self.zero_g else torch.zeros_like(g_src), tau=tau)
-        z_p = self.flow(z, y_mask, g=g_src)
-        z_hat = self.flow(z_p, y_mask, g=g_tgt, reverse=True)
-        o_hat = self.dec(z_hat * y_mask, g=g_tgt if not self.zero_g else torch.zeros_like(g_tgt))
+        cond = conditioning or {}
+        z, m_q, logs_q, y_mask = self.enc_q(y, y_lengths, g=g_src if not self.zero_g else torch.zeros_like(g_src), tau=tau,
+                                            g_cond=cond.get('enc_q'))
+        z_p = self.flow(z, y_mask, g=g_src, g_conds=cond.get('flow_src'))
+        z_hat = self.flow(z_p, y_mask, g=g_tgt, reverse=True, g_conds=cond.get('flow_tgt'))
+        o_hat = self.dec(z_hat * y_mask, g=g_tgt if not self.zero_g else torch.zeros_like(g_tgt), g_cond=cond.get('dec'),
+                         x_mask=y_mask)
         return o_hat, y_mask, (z, z_p, z_hat)
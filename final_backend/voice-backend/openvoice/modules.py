@@ -13,6 +13,9 @@ from openvoice.attentions import Encoder
 
 LRELU_SLOPE = 0.1
 
+# torch.compiler.is_compiling only exists from torch 2.1 on
+_is_compiling = getattr(getattr(torch, "compiler", None), "is_compiling", lambda: False)
+
 
 class LayerNorm(nn.Module):
     def __init__(self, channels, eps=1e-5):
@@ -182,11 +185,18 @@ class WN(torch.nn.Module):
             res_skip_layer = torch.nn.utils.weight_norm(res_skip_layer, name="weight")
             self.res_skip_layers.append(res_skip_layer)
 
-    def forward(self, x, x_mask, g=None, **kwargs):
+    def condition(self, g):
+        """Projects a speaker embedding for every layer; pass the result as
+        `g_cond` to skip the projection in forward."""
+        return self.cond_layer(g)
+
+    def forward(self, x, x_mask, g=None, g_cond=None, **kwargs):
         output = torch.zeros_like(x)
         n_channels_tensor = torch.IntTensor([self.hidden_channels])
 
-        if g is not None:
+        if g_cond is not None:
+            g = g_cond
+        elif g is not None:
             g = self.cond_layer(g)
 
         for i in range(self.n_layers):
@@ -197,7 +207,13 @@ class WN(torch.nn.Module):
             else:
                 g_l = torch.zeros_like(x_in)
 
-            acts = commons.fused_add_tanh_sigmoid_multiply(x_in, g_l, n_channels_tensor)
+            if _is_compiling():
+                # The scripted helper reads n_channels from a tensor, a graph
+                # break for torch.compile; the same ops inline compile cleanly
+                in_act = x_in + g_l
+                acts = torch.tanh(in_act[:, : self.hidden_channels]) * torch.sigmoid(in_act[:, self.hidden_channels :])
+            else:
+                acts = commons.fused_add_tanh_sigmoid_multiply(x_in, g_l, n_channels_tensor)
             acts = self.drop(acts)
 
             res_skip_acts = self.res_skip_layers[i](acts)
@@ -434,10 +450,10 @@ class ResidualCouplingLayer(nn.Module):
         self.post.weight.data.zero_()
         self.post.bias.data.zero_()
 
-    def forward(self, x, x_mask, g=None, reverse=False):
+    def forward(self, x, x_mask, g=None, reverse=False, g_cond=None):
         x0, x1 = torch.split(x, [self.half_channels] * 2, 1)
         h = self.pre(x0) * x_mask
-        h = self.enc(h, x_mask, g=g)
+        h = self.enc(h, x_mask, g=g, g_cond=g_cond)
         stats = self.post(h) * x_mask
         if not self.mean_only:
             m, logs = torch.split(stats, [self.half_channels] * 2, 1)
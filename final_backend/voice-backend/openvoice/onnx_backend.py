@@ -0,0 +1,98 @@
+import numpy as np
+import torch
+
+# ONNX export of the two synthesis paths of SynthesizerTrn, and an ONNX Runtime
+# stand-in that ToneColorConverter / BaseSpeakerTTS call in place of the model:
+#   voice_conversion  enc_q -> flow -> reverse flow -> dec   (ToneColorConverter)
+#   infer             enc_p -> sdp/dp -> flow -> dec         (BaseSpeakerTTS)
+# Batch and time axes are dynamic, so one graph serves every line length.
+
+
+class _VoiceConversion(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, spec, spec_lengths, sid_src, sid_tgt, tau):
+        o_hat, y_mask, _ = self.model.voice_conversion(spec, spec_lengths, sid_src, sid_tgt, tau=tau)
+        return o_hat, y_mask
+
+
+class _Infer(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, x, x_lengths, sid, noise_scale, length_scale, noise_scale_w):
+        o, _, y_mask, _ = self.model.infer(x, x_lengths, sid=sid, noise_scale=noise_scale,
+                                           length_scale=length_scale, noise_scale_w=noise_scale_w)
+        return o, y_mask
+
+
+def _scalar(value):
+    return torch.tensor(value, dtype=torch.float32)
+
+
+def export_onnx(model, entry, path, opset_version=17):
+    """Exports `model.voice_conversion` or `model.infer` (entry) to an ONNX file.
+    Fold weight norm first (SynthesizerTrn.remove_weight_norm), or the graph
+    recomputes every conv weight on each run."""
+    gin_channels = model.flow.gin_channels
+    if entry == 'voice_conversion':
+        spec_channels = model.enc_q.in_channels
+        wrapper = _VoiceConversion(model)
+        args = (torch.rand(2, spec_channels, 64), torch.LongTensor([64, 48]),
+                torch.randn(2, gin_channels, 1), torch.randn(2, gin_channels, 1), _scalar(0.3))
+        input_names = ['spec', 'spec_lengths', 'sid_src', 'sid_tgt', 'tau']
+        dynamic_axes = {'spec': {0: 'batch', 2: 'frames'}, 'spec_lengths': {0: 'batch'},
+                        'sid_src': {0: 'batch'}, 'sid_tgt': {0: 'batch'}}
+    elif entry == 'infer':
+        wrapper = _Infer(model)
+        args = (torch.randint(1, 20, (2, 32)), torch.LongTensor([32, 24]), torch.LongTensor([0, 0]),
+                _scalar(0.667), _scalar(1.0), _scalar(0.6))
+        input_names = ['x', 'x_lengths', 'sid', 'noise_scale', 'length_scale', 'noise_scale_w']
+        dynamic_axes = {'x': {0: 'batch', 1: 'phonemes'}, 'x_lengths': {0: 'batch'}, 'sid': {0: 'batch'}}
+    else:
+        raise ValueError(f"Unknown ONNX entry point: {entry}")
+    dynamic_axes.update({'audio': {0: 'batch', 2: 'samples'}, 'y_mask': {0: 'batch', 2: 'frames'}})
+
+    model.eval()
+    with torch.no_grad():
+        torch.onnx.export(wrapper.eval(), args, path, dynamo=False, opset_version=opset_version,
+                          input_names=input_names, output_names=['audio', 'y_mask'],
+                          dynamic_axes=dynamic_axes)
+    print("Exported {} to '{}'".format(entry, path))
+
+
+class OnnxSynthesizer:
+    """Runs an exported graph with ONNX Runtime (all graph optimizations on)
+    behind the same voice_conversion / infer signatures as SynthesizerTrn.
+    Arguments the graph does not take (sdp_ratio, max_len) keep their export
+    defaults, and the graph computes its own speaker conditioning."""
+
+    def __init__(self, path, device='cpu', threads=None):
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads or torch.get_num_threads()
+        providers = ['CPUExecutionProvider']
+        if 'cuda' in str(device):
+            providers.insert(0, 'CUDAExecutionProvider')
+        self.session = ort.InferenceSession(path, options, providers=providers)
+        self.device = device
+
+    def _run(self, **feeds):
+        feeds = {
+            name: value.detach().contiguous().cpu().numpy() if torch.is_tensor(value) else np.asarray(value, dtype=np.float32)
+            for name, value in feeds.items()
+        }
+        return [torch.from_numpy(output).to(self.device) for output in self.session.run(None, feeds)]
+
+    def voice_conversion(self, y, y_lengths, sid_src, sid_tgt, tau=1.0, conditioning=None):
+        o_hat, y_mask = self._run(spec=y, spec_lengths=y_lengths, sid_src=sid_src, sid_tgt=sid_tgt, tau=tau)
+        return o_hat, y_mask, None
+
+    def infer(self, x, x_lengths, sid=None, noise_scale=1, length_scale=1, noise_scale_w=1., sdp_ratio=0.2, max_len=None):
+        o, y_mask = self._run(x=x, x_lengths=x_lengths, sid=sid, noise_scale=noise_scale,
+                              length_scale=length_scale, noise_scale_w=noise_scale_w)
+        return o, None, y_mask, None
@@ -0,0 +1,67 @@
+import torch
+from torch import nn
+from torch.nn import functional as F
+
+# Opt-in int8 modes for CPU inference, applied by optimize_for_inference(quantize=...):
+#   "dynamic"  Linear and GRU layers (ReferenceEncoder, TextEncoder speaker
+#              projection) run as dynamically quantized int8 kernels
+#   "weights"  Conv1d / ConvTranspose1d weights in the decoder, flows and
+#              encoders are stored as int8 with one scale per output channel
+#              and expanded to float on each call; compute stays in float
+#   "all"      both
+# Dynamically quantized convolutions were tried for the conv stacks too, but
+# were slower than float on CPU and audibly degraded the decoder output.
+QUANTIZE_MODES = ("dynamic", "weights", "all")
+# Submodules whose convolutions get int8 weights
+WEIGHT_QUANTIZED_MODULES = ("dec", "flow", "enc_q", "enc_p")
+
+
+class Int8WeightConv1d(nn.Module):
+    """A Conv1d or ConvTranspose1d with its weight held as int8 plus a float
+    scale per output channel, about a quarter of the float weight's memory."""
+
+    def __init__(self, conv):
+        super().__init__()
+        self.transposed = isinstance(conv, nn.ConvTranspose1d)
+        weight = conv.weight.detach()
+        channel_dim = 1 if self.transposed else 0
+        reduce_dims = [dim for dim in range(weight.dim()) if dim != channel_dim]
+        scale = weight.abs().amax(dim=reduce_dims, keepdim=True).clamp_min(1e-8) / 127
+        self.register_buffer("weight_int8", torch.round(weight / scale).to(torch.int8))
+        self.register_buffer("scale", scale)
+        self.bias = None if conv.bias is None else nn.Parameter(conv.bias.detach().clone(), requires_grad=False)
+        self.stride = conv.stride
+        self.padding = conv.padding
+        self.dilation = conv.dilation
+        self.groups = conv.groups
+        self.output_padding = getattr(conv, "output_padding", 0)
+
+    def forward(self, x):
+        weight = self.weight_int8.to(x.dtype) * self.scale.to(x.dtype)
+        if self.transposed:
+            return F.conv_transpose1d(x, weight, self.bias, self.stride, self.padding,
+                                      self.output_padding, self.groups, self.dilation)
+        return F.conv1d(x, weight, self.bias, self.stride, self.padding, self.dilation, self.groups)
+
+
+def _quantize_conv_weights(module):
+    for name, child in module.named_children():
+        if isinstance(child, (nn.Conv1d, nn.ConvTranspose1d)):
+            setattr(module, name, Int8WeightConv1d(child))
+        else:
+            _quantize_conv_weights(child)
+
+
+def quantize_model(model, mode):
+    """Quantizes a SynthesizerTrn in place for CPU inference (see QUANTIZE_MODES).
+    Weight norm has to be folded first (SynthesizerTrn.remove_weight_norm)."""
+    if mode not in QUANTIZE_MODES:
+        raise ValueError(f"Unknown quantize mode: {mode} (expected one of {', '.join(QUANTIZE_MODES)})")
+    if mode in ("weights", "all"):
+        for name in WEIGHT_QUANTIZED_MODULES:
+            if hasattr(model, name):
+                _quantize_conv_weights(getattr(model, name))
+    if mode in ("dynamic", "all"):
+        from torch.ao.quantization import quantize_dynamic
+        quantize_dynamic(model, {nn.Linear, nn.GRU}, dtype=torch.qint8, inplace=True)
+    return model
@@ -13,13 +13,15 @@ import base64
 import librosa
 from whisper_timestamped.transcribe import get_audio_tensor, get_vad_segments
 
-model_size = "medium"
-# Run on GPU with FP16
+model_size = os.getenv("SE_ASR_MODEL", "medium")
+# Run on GPU with FP16 when there is one, otherwise int8 on CPU
+device = os.getenv("SE_ASR_DEVICE") or ("cuda" if torch.cuda.is_available() else "cpu")
+compute_type = os.getenv("SE_ASR_COMPUTE_TYPE") or ("float16" if device == "cuda" else "int8")
 model = None
 def split_audio_whisper(audio_path, audio_name, target_dir='processed'):
     global model
     if model is None:
-        model = WhisperModel(model_size, device="cuda", compute_type="float16")
+        model = WhisperModel(model_size, device=device, compute_type=compute_type)
     audio = AudioSegment.from_file(audio_path)
     max_len = len(audio)
 
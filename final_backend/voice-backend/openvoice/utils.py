@@ -75,6 +75,33 @@ def bits_to_string(bits_array):
     return output_string
 
 
+def concat_audio_segments(segments, gap=0, dtype=np.float32):
+    """Joins 1-D audio segments (numpy arrays or tensors), with `gap` samples of
+    silence after each one, into a single preallocated array."""
+    segments = [np.asarray(segment.cpu() if hasattr(segment, 'cpu') else segment).reshape(-1) for segment in segments]
+    audio = np.zeros(sum(len(segment) for segment in segments) + gap * len(segments), dtype=dtype)
+    offset = 0
+    for segment in segments:
+        audio[offset:offset + len(segment)] = segment
+        offset += len(segment) + gap
+    return audio
+
+
+def length_buckets(lengths, batch_size, max_ratio=1.3):
+    """Groups item indices into batches of similar length, shortest first.
+
+    A batch holds at most `batch_size` items and its longest item is at most
+    `max_ratio` times its shortest, which bounds the padding per batch."""
+    batches = []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        batch = batches[-1] if batches else None
+        if batch is None or len(batch) >= batch_size or lengths[i] > max_ratio * max(lengths[batch[0]], 1):
+            batches.append([i])
+        else:
+            batch.append(i)
+    return batches
+
+
 def split_sentence(text, min_len=10, language_str='[EN]'):
     if language_str in ['EN']:
         sentences = split_sentences_latin(text, min_len=min_len)
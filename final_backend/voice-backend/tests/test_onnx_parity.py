@@ -0,0 +1,82 @@
+import pytest
+import torch
+
+pytest.importorskip("onnx")
+pytest.importorskip("onnxruntime")
+
+from openvoice.models import SynthesizerTrn
+from openvoice.onnx_backend import OnnxSynthesizer, export_onnx
+
+SPEC_CHANNELS = 65
+GIN_CHANNELS = 32
+N_VOCAB = 40
+
+# A scaled-down SynthesizerTrn: same graph as the shipped configs, small enough
+# to export and run in a few seconds
+MODEL_CONFIG = dict(
+    inter_channels=48, hidden_channels=48, filter_channels=96, n_heads=2, n_layers=2,
+    kernel_size=3, p_dropout=0.1, resblock="1", resblock_kernel_sizes=[3, 7],
+    resblock_dilation_sizes=[[1, 3, 5], [1, 3, 5]], upsample_rates=[4, 4, 2],
+    upsample_initial_channel=64, upsample_kernel_sizes=[8, 8, 4], gin_channels=GIN_CHANNELS,
+)
+
+
+def build_model(n_speakers, seed):
+    torch.manual_seed(seed)
+    model = SynthesizerTrn(N_VOCAB, SPEC_CHANNELS, n_speakers=n_speakers, **MODEL_CONFIG).eval()
+    model.remove_weight_norm()
+    return model
+
+
+@pytest.fixture(scope="module")
+def converter(tmp_path_factory):
+    model = build_model(n_speakers=0, seed=0)
+    path = str(tmp_path_factory.mktemp("onnx") / "voice_conversion.onnx")
+    export_onnx(model, "voice_conversion", path)
+    return model, OnnxSynthesizer(path, threads=1)
+
+
+@pytest.fixture(scope="module")
+def tts(tmp_path_factory):
+    model = build_model(n_speakers=4, seed=1)
+    path = str(tmp_path_factory.mktemp("onnx") / "infer.onnx")
+    export_onnx(model, "infer", path)
+    return model, OnnxSynthesizer(path, threads=1)
+
+
+# Lengths differ from the export examples (64/48 frames, 32/24 phonemes), so the
+# dynamic axes are what is being exercised
+@pytest.mark.parametrize("lengths", [[50], [80, 37]])
+def test_voice_conversion_matches_pytorch(converter, lengths):
+    model, onnx = converter
+    generator = torch.Generator().manual_seed(len(lengths))
+    spec = torch.rand(len(lengths), SPEC_CHANNELS, max(lengths), generator=generator)
+    spec_lengths = torch.LongTensor(lengths)
+    sid_src = torch.randn(len(lengths), GIN_CHANNELS, 1, generator=generator)
+    sid_tgt = torch.randn(len(lengths), GIN_CHANNELS, 1, generator=generator)
+
+    with torch.no_grad():
+        expected, expected_mask, _ = model.voice_conversion(spec, spec_lengths, sid_src, sid_tgt, tau=0.0)
+    audio, y_mask, _ = onnx.voice_conversion(spec, spec_lengths, sid_src, sid_tgt, tau=0.0)
+
+    assert audio.shape == expected.shape
+    assert torch.equal(y_mask, expected_mask)
+    torch.testing.assert_close(audio, expected, rtol=0, atol=1e-5)
+
+
+@pytest.mark.parametrize("lengths", [[19], [41, 27]])
+def test_infer_matches_pytorch(tts, lengths):
+    model, onnx = tts
+    generator = torch.Generator().manual_seed(len(lengths))
+    x = torch.randint(1, N_VOCAB, (len(lengths), max(lengths)), generator=generator)
+    x_lengths = torch.LongTensor(lengths)
+    sid = torch.LongTensor([2] * len(lengths))
+    kwargs = dict(noise_scale=0.0, length_scale=1.0, noise_scale_w=0.0)
+
+    with torch.no_grad():
+        expected, _, expected_mask, _ = model.infer(x, x_lengths, sid=sid, **kwargs)
+    audio, _, y_mask, _ = onnx.infer(x, x_lengths, sid=sid, **kwargs)
+
+    assert audio.shape == expected.shape
+    assert torch.equal(y_mask, expected_mask)
+    torch.testing.assert_close(audio, expected, rtol=0, atol=1e-5)